@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """带随机抖动的指数退避时间（秒）"""
+    limit = min(cap, base * (2 ** attempt))
+    return random.uniform(limit / 2, limit)
+
+
+class AdaptiveLimiter:
+    """AIMD并发控制器：延迟平稳时逐步加并发，出现超时或错误时按比例减并发"""
+
+    def __init__(self, initial=2, min_limit=1, max_limit=16, decrease_factor=0.5,
+                 latency_tolerance=1.5, backoff_base=1.0, backoff_max=30.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max(min_limit, min(initial, max_limit))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance  # 延迟超过基线的倍数时停止加并发
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.in_flight = 0
+        self.successes_since_change = 0
+        self.last_decrease = 0.0
+        self.latency_ewma = None  # 每字符延迟的滑动平均
+        self.latency_baseline = None
+        self.errors = 0
+        self.completed = deque()  # (完成时间, 字符数)，用于计算吞吐量
+        self._condition = None
+        self._loop = None
+
+    @classmethod
+    def fixed(cls, limit):
+        """固定并发数，只使用其退避和统计功能"""
+        return cls(initial=limit, min_limit=limit, max_limit=limit)
+
+    @property
+    def adaptive(self):
+        return self.min_limit != self.max_limit
+
+    @asynccontextmanager
+    async def request(self, chars, ready=None):
+        """占用一个并发名额执行一次请求，并根据结果调整并发上限，得到True
+
+        ready为可调用对象时，在有空闲名额、即将占用时检查：返回False（如提交方已暂停）时不占用名额，得到False
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 同一个控制器可能先后用于多个事件循环
+            self._loop = loop
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            acquired = ready is None or ready()
+            if acquired:
+                self.in_flight += 1
+        if not acquired:
+            yield False
+            return
+
+        started = time.monotonic()
+        try:
+            yield True
+        except BaseException as e:
+            if not isinstance(e, asyncio.CancelledError):
+                self.on_error(started)
+            raise
+        else:
+            self.on_success(started, chars)
+        finally:
+            async with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def on_success(self, started, chars):
+        now = time.monotonic()
+        self.completed.append((now, chars))
+
+        per_char = (now - started) / max(chars, 1)
+        if self.latency_ewma is None:
+            self.latency_ewma = per_char
+        else:
+            self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * per_char
+        if self.latency_baseline is None or self.latency_ewma < self.latency_baseline:
+            self.latency_baseline = self.latency_ewma
+
+        self.successes_since_change += 1
+        if self.successes_since_change < self.limit:
+            return
+
+        # 完成一轮（limit个请求）后再决定是否加并发
+        self.successes_since_change = 0
+        if self.latency_ewma <= self.latency_baseline * self.latency_tolerance:
+            if self.limit < self.max_limit:
+                self.limit += 1
+                logger.info("并发上限提高到 %d", self.limit)
+        else:
+            # 延迟升高但没有出错：保持不变，并让基线缓慢上移以适应服务波动
+            self.latency_baseline *= 1.05
+
+    def on_error(self, started):
+        self.errors += 1
+        self.successes_since_change = 0
+        # 在上一次减并发之前发出的请求失败，不重复惩罚
+        if started < self.last_decrease:
+            return
+        self.last_decrease = time.monotonic()
+        new_limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+        if new_limit != self.limit:
+            self.limit = new_limit
+            logger.info("并发上限降低到 %d", self.limit)
+
+    def backoff_delay(self, attempt):
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max)
+
+    def throughput(self, window=30.0):
+        """最近window秒内的吞吐量，返回(请求数/秒, 字符数/秒)"""
+        now = time.monotonic()
+        while self.completed and self.completed[0][0] < now - window:
+            self.completed.popleft()
+        if not self.completed:
+            return 0.0, 0.0
+        span = max(now - self.completed[0][0], 1.0)
+        chars = sum(c for _, c in self.completed)
+        return len(self.completed) / span, chars / span
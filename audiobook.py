@@ -0,0 +1,395 @@
+"""整本书的有声书文件：按顺序拼接章节MP3，一次写完，章节位置在写入时由帧数算出，不需要再解码
+
+MP3格式在文件开头写入带CHAP/CTOC帧的ID3v2.4标签；M4B格式把同样的MP3帧（不重新编码）放进MP4容器，
+章节写成QuickTime章节轨道和Nero的chpl（后者最多255章）。
+"""
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import namedtuple
+
+from mp3_concat import (BITRATES_V1, BITRATES_V2, Mp3Writer, audio_runs, copy_range, frame_sample_rate,
+                        samples_per_frame)
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("mp3", "m4b")
+
+# 章节在有声书中的位置，start和end为秒
+ChapterMark = namedtuple('ChapterMark', 'title start end')
+
+
+def write_audiobook(path, chapters, fmt=None, title=None, author=None):
+    """把[(章节标题, MP3文件)]按顺序写成一个有声书文件，fmt为mp3或m4b（默认按扩展名），返回ChapterMark列表
+
+    先写入临时文件，完成后再替换path，中途失败不会留下不完整的有声书
+    """
+    fmt = fmt or os.path.splitext(path)[1][1:].lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"不支持的有声书格式: {fmt}")
+    writer_class = Mp3Audiobook if fmt == "mp3" else M4bAudiobook
+    temp_path = path + ".part"
+    try:
+        with open(temp_path, 'w+b') as f:
+            book = writer_class(f, [chapter_title for chapter_title, _ in chapters], title, author)
+            for _, chapter_path in chapters:
+                book.add_chapter(chapter_path)
+            marks = book.finish()
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    logger.info("有声书已写入: %s (%d 章, %.1f 秒)", path, len(marks), marks[-1].end if marks else 0.0)
+    return marks
+
+
+def utf8_truncate(text, limit):
+    """UTF-8编码后截断到limit字节以内，不截断多字节字符"""
+    return text.encode('utf-8')[:limit].decode('utf-8', errors='ignore').encode('utf-8')
+
+
+# ---- ID3v2.4 ----
+
+def synchsafe(value):
+    return bytes(((value >> shift) & 0x7F) for shift in (21, 14, 7, 0))
+
+
+def id3_frame(frame_id, payload):
+    return frame_id + synchsafe(len(payload)) + b'\x00\x00' + payload
+
+
+def id3_text(frame_id, text):
+    return id3_frame(frame_id, b'\x03' + text.encode('utf-8'))  # 编码3为UTF-8
+
+
+class Mp3Audiobook:
+    """带章节的MP3：先按标题算出标签大小并预留位置（时间字段定长），写完音频后回填标签"""
+
+    TOC_ENTRIES = 255  # 一个CTOC帧最多的子项数，更多的章节分成多个子目录
+
+    def __init__(self, file, titles, title=None, author=None):
+        self.file = file
+        self.titles = titles
+        self.title = title
+        self.author = author
+        self.frames = []  # 每章开始时已写入的帧数，最后是总帧数
+        self.tag_size = len(self._tag([0] * (len(titles) + 1), 1, 1))
+        file.write(bytes(self.tag_size))
+        self.writer = Mp3Writer(file, base=self.tag_size)
+
+    def add_chapter(self, path):
+        self.frames.append(self.writer.frame_count)
+        self.writer.append_file(path)
+
+    def finish(self):
+        if len(self.frames) != len(self.titles):
+            raise ValueError("章节数与标题数不一致")
+        if self.writer.first_frame is None:
+            raise ValueError("没有音频")
+        self.frames.append(self.writer.frame_count)
+        self.writer.finish()
+        first = self.writer.first_frame
+        marks = chapter_marks(self.titles, self.frames, samples_per_frame(first), frame_sample_rate(first))
+        tag = self._tag(self.frames, samples_per_frame(first), frame_sample_rate(first))
+        if len(tag) != self.tag_size:
+            raise ValueError("ID3标签大小与预留的不一致")
+        self.file.seek(0)
+        self.file.write(tag)
+        self.file.flush()
+        return marks
+
+    def _tag(self, frames, frame_samples, sample_rate):
+        def millis(index):
+            return frames[index] * frame_samples * 1000 // sample_rate
+
+        body = bytearray()
+        if self.title:
+            body += id3_text(b'TIT2', self.title) + id3_text(b'TALB', self.title)
+        if self.author:
+            body += id3_text(b'TPE1', self.author)
+
+        chapter_ids = [f"chp{i}".encode() for i in range(len(self.titles))]
+        if len(chapter_ids) <= self.TOC_ENTRIES:
+            body += self._ctoc(b'toc', chapter_ids, top_level=True)
+        else:
+            groups = [chapter_ids[i:i + self.TOC_ENTRIES] for i in range(0, len(chapter_ids), self.TOC_ENTRIES)]
+            if len(groups) > self.TOC_ENTRIES:
+                raise ValueError("章节太多，ID3目录无法容纳")
+            group_ids = [f"toc{i}".encode() for i in range(len(groups))]
+            body += self._ctoc(b'toc', group_ids, top_level=True)
+            for group_id, group in zip(group_ids, groups):
+                body += self._ctoc(group_id, group, top_level=False)
+        for i, (chapter_id, chapter_title) in enumerate(zip(chapter_ids, self.titles)):
+            # 字节偏移为0xFFFFFFFF表示不使用，播放器按时间定位
+            timing = struct.pack('>IIII', millis(i), millis(i + 1), 0xFFFFFFFF, 0xFFFFFFFF)
+            body += id3_frame(b'CHAP', chapter_id + b'\x00' + timing + id3_text(b'TIT2', chapter_title))
+        return b'ID3\x04\x00\x00' + synchsafe(len(body)) + body
+
+    @staticmethod
+    def _ctoc(element_id, children, top_level):
+        flags = 0x03 if top_level else 0x01  # 0x02为顶层目录，0x01为有序
+        payload = element_id + b'\x00' + bytes([flags, len(children)]) + b''.join(child + b'\x00' for child in children)
+        return id3_frame(b'CTOC', payload)
+
+
+def chapter_marks(titles, frames, frame_samples, sample_rate):
+    return [ChapterMark(chapter_title, frames[i] * frame_samples / sample_rate,
+                        frames[i + 1] * frame_samples / sample_rate)
+            for i, chapter_title in enumerate(titles)]
+
+
+# ---- MP4 ----
+
+def box(kind, *payloads):
+    data = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(data), kind) + data
+
+
+def full_box(kind, version, flags, *payloads):
+    return box(kind, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+def big_endian(values, typecode):
+    """array转换为大端字节串（stsz等表可能有上百万项）"""
+    values = array(typecode, values)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+def descriptor(tag, payload):
+    """MPEG-4描述符，长度用变长编码"""
+    size = len(payload)
+    encoded = [size & 0x7F]
+    size >>= 7
+    while size:
+        encoded.append(0x80 | (size & 0x7F))
+        size >>= 7
+    return bytes([tag]) + bytes(reversed(encoded)) + payload
+
+
+MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+LANGUAGE_UND = 0x55C4  # ISO-639-2 "und"，每个字母5位
+
+
+class M4bAudiobook:
+    """MP4容器中的MP3有声书：mdat在写入时流式追加，moov（帧大小表和章节）最后写在文件末尾
+
+    每个MP3帧是一个样本，章节轨道的每个样本是一个章节标题，时长为该章的帧数
+    """
+
+    CHUNK_FRAMES = 64  # 每个chunk的帧数（约1.5秒）
+    AUDIO_TRACK = 1
+    CHAPTER_TRACK = 2
+    NERO_CHAPTERS = 255  # chpl最多的章节数
+
+    def __init__(self, file, titles, title=None, author=None):
+        self.file = file
+        self.titles = titles
+        self.title = title
+        self.author = author
+        self.first_frame = None
+        self.frames = []  # 每章开始时的帧数，最后是总帧数
+        self.sizes = array('H')  # 每帧的字节数
+        self.chunk_offsets = array('Q')
+        self.bitrates = set()
+        file.write(box(b'ftyp', b'M4B ', struct.pack('>I', 0), b'M4B M4A mp42isom'))
+        self.mdat_offset = file.tell()
+        file.write(struct.pack('>I4sQ', 1, b'mdat', 0))  # 64位长度，写完后回填
+        self.position = file.tell()
+
+    def add_chapter(self, path):
+        self.frames.append(len(self.sizes))
+        with open(path, 'rb') as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                raise ValueError(f"空的MP3文件: {path}")
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                runs, frames = audio_runs(data)
+                if not frames:
+                    raise ValueError(f"不是有效的MP3文件: {path}")
+                pos = self.position
+                for frame in frames:
+                    self._check(frame, path)
+                    if len(self.sizes) % self.CHUNK_FRAMES == 0:
+                        self.chunk_offsets.append(pos)
+                    self.sizes.append(frame.length)
+                    self.bitrates.add(frame.bitrate_index)
+                    pos += frame.length
+                self.file.flush()
+                for start, end in runs:
+                    self.position = copy_range(infile.fileno(), data, start, end, self.file, self.position)
+        self.file.seek(self.position)
+
+    def _check(self, frame, path):
+        if self.first_frame is None:
+            self.first_frame = frame
+        elif (frame.version, frame.sample_rate_index) != (self.first_frame.version, self.first_frame.sample_rate_index):
+            raise ValueError(f"采样率与前面的章节不一致: {path}")
+
+    def finish(self):
+        if len(self.frames) != len(self.titles):
+            raise ValueError("章节数与标题数不一致")
+        if self.first_frame is None:
+            raise ValueError("没有音频")
+        self.frames.append(len(self.sizes))
+        frame_samples = samples_per_frame(self.first_frame)
+        sample_rate = frame_sample_rate(self.first_frame)
+
+        # 章节标题作为文本样本写在音频之后
+        text_samples = [struct.pack('>H', len(encoded)) + encoded + box(b'encd', struct.pack('>I', 0x100))
+                        for encoded in (chapter_title.encode('utf-8') for chapter_title in self.titles)]
+        text_offsets = []
+        self.file.seek(self.position)
+        for sample in text_samples:
+            text_offsets.append(self.position)
+            self.file.write(sample)
+            self.position += len(sample)
+        self.file.seek(self.mdat_offset + 8)
+        self.file.write(struct.pack('>Q', self.position - self.mdat_offset))
+        self.file.seek(self.position)
+
+        durations = [(self.frames[i + 1] - self.frames[i]) * frame_samples for i in range(len(self.titles))]
+        total_samples = len(self.sizes) * frame_samples
+        self.file.write(self._moov(sample_rate, frame_samples, total_samples, durations,
+                                   [len(sample) for sample in text_samples], text_offsets))
+        self.file.flush()
+        return chapter_marks(self.titles, self.frames, frame_samples, sample_rate)
+
+    def _moov(self, sample_rate, frame_samples, total_samples, durations, text_sizes, text_offsets):
+        movie_duration = total_samples * 1000 // sample_rate  # 影片时间单位为毫秒
+        header = self._versioned(b'mvhd', movie_duration, lambda wide: (
+            (struct.pack('>QQIQ', 0, 0, 1000, movie_duration) if wide else
+             struct.pack('>IIII', 0, 0, 1000, movie_duration))
+            + struct.pack('>IH10x', 0x10000, 0x100) + MATRIX + bytes(24)
+            + struct.pack('>I', self.CHAPTER_TRACK + 1)))
+        tracks = [self._audio_track(sample_rate, frame_samples, total_samples, movie_duration)]
+        if self.titles:
+            tracks.append(self._chapter_track(sample_rate, total_samples, movie_duration, durations,
+                                              text_sizes, text_offsets))
+        return box(b'moov', header, *tracks, self._user_data())
+
+    @staticmethod
+    def _versioned(kind, duration, build, flags=0):
+        """时长超过32位时使用version 1（64位时间字段）"""
+        wide = duration > 0xFFFFFFFF
+        return full_box(kind, 1 if wide else 0, flags, build(wide))
+
+    def _track_header(self, track_id, movie_duration, enabled, volume):
+        flags = 0x3 if enabled else 0x0  # 0x1启用，0x2在影片中使用
+        return self._versioned(b'tkhd', movie_duration, lambda wide: (
+            (struct.pack('>QQIIQ', 0, 0, track_id, 0, movie_duration) if wide else
+             struct.pack('>IIIII', 0, 0, track_id, 0, movie_duration))
+            + struct.pack('>8xhhH2x', 0, 0, volume) + MATRIX + struct.pack('>II', 0, 0)), flags)
+
+    def _media(self, handler, name, sample_rate, total_samples, media_header, sample_table):
+        media_time = self._versioned(b'mdhd', total_samples, lambda wide: (
+            (struct.pack('>QQIQ', 0, 0, sample_rate, total_samples) if wide else
+             struct.pack('>IIII', 0, 0, sample_rate, total_samples))
+            + struct.pack('>HH', LANGUAGE_UND, 0)))
+        handler_box = full_box(b'hdlr', 0, 0, struct.pack('>I4s12x', 0, handler), name.encode() + b'\x00')
+        data_info = box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1), full_box(b'url ', 0, 1)))
+        return box(b'mdia', media_time, handler_box, box(b'minf', media_header, data_info, sample_table))
+
+    def _audio_track(self, sample_rate, frame_samples, total_samples, movie_duration):
+        frame = self.first_frame
+        channels = 1 if frame.channel_mode == 3 else 2
+        bitrates = BITRATES_V1 if frame.version == 3 else BITRATES_V2
+        audio_bytes = sum(self.sizes)
+        seconds = total_samples / sample_rate
+        average_bitrate = round(audio_bytes * 8 / seconds) if seconds else 0
+        max_bitrate = max(bitrates[index] for index in self.bitrates) * 1000
+        object_type = 0x6B if frame.version == 3 else 0x69  # MPEG-1音频 / MPEG-2音频（低采样率）
+        decoder_config = descriptor(0x04, struct.pack('>BB', object_type, 0x15)  # 音频流
+                                    + max(self.sizes).to_bytes(3, 'big')
+                                    + struct.pack('>II', max_bitrate, average_bitrate))
+        es = descriptor(0x03, struct.pack('>HB', self.AUDIO_TRACK, 0) + decoder_config + descriptor(0x06, b'\x02'))
+        sample_entry = box(b'mp4a', bytes(6), struct.pack('>H8xHHHHI', 1, channels, 16, 0, 0, sample_rate << 16),
+                           full_box(b'esds', 0, 0, es))
+
+        sizes = set(self.sizes)
+        if len(sizes) == 1:
+            sample_sizes = full_box(b'stsz', 0, 0, struct.pack('>II', sizes.pop(), len(self.sizes)))
+        else:
+            sample_sizes = full_box(b'stsz', 0, 0, struct.pack('>II', 0, len(self.sizes)), big_endian(self.sizes, 'I'))
+        # 除最后一个chunk外每个chunk都是CHUNK_FRAMES帧
+        chunk_count = len(self.chunk_offsets)
+        remainder = len(self.sizes) % self.CHUNK_FRAMES
+        chunk_map = [(1, self.CHUNK_FRAMES)] if chunk_count > 1 or not remainder else []
+        if remainder:
+            chunk_map.append((chunk_count, remainder))
+        sample_table = box(b'stbl',
+                           full_box(b'stsd', 0, 0, struct.pack('>I', 1), sample_entry),
+                           full_box(b'stts', 0, 0, struct.pack('>III', 1, len(self.sizes), frame_samples)),
+                           self._chunk_map(chunk_map),
+                           sample_sizes,
+                           self._chunk_offsets(self.chunk_offsets))
+        media = self._media(b'soun', "SoundHandler", sample_rate, total_samples,
+                            full_box(b'smhd', 0, 0, struct.pack('>hH', 0, 0)), sample_table)
+        references = [box(b'tref', box(b'chap', struct.pack('>I', self.CHAPTER_TRACK)))] if self.titles else []
+        return box(b'trak', self._track_header(self.AUDIO_TRACK, movie_duration, True, 0x100), *references, media)
+
+    def _chapter_track(self, sample_rate, total_samples, movie_duration, durations, text_sizes, text_offsets):
+        # QuickTime文本样本描述：显示标志、对齐、背景色、文本框、字体和前景色，最后是空的字体名
+        sample_entry = box(b'text', bytes(6), struct.pack('>H', 1),
+                           struct.pack('>Ii3H4H8xHHBH3H', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+                           b'\x00')
+        sample_table = box(b'stbl',
+                           full_box(b'stsd', 0, 0, struct.pack('>I', 1), sample_entry),
+                           self._time_to_sample(durations),
+                           self._chunk_map([(1, 1)]),
+                           full_box(b'stsz', 0, 0, struct.pack('>II', 0, len(text_sizes)), big_endian(text_sizes, 'I')),
+                           self._chunk_offsets(text_offsets))
+        # 文本轨道的媒体头为gmhd，格式与ffmpeg写入的章节轨道相同
+        base_media = full_box(b'gmin', 0, 0, struct.pack('>H3HhH', 0x40, 0x8000, 0x8000, 0x8000, 0, 0))
+        text_info = box(b'text', struct.pack('>H8IH', 1, 0, 0, 0, 1, 0, 0, 0, 0x4000, 0))
+        media = self._media(b'text', "ChapterHandler", sample_rate, total_samples,
+                            box(b'gmhd', base_media, text_info), sample_table)
+        # 章节轨道不启用，播放器只把它当作目录，不显示为字幕
+        return box(b'trak', self._track_header(self.CHAPTER_TRACK, movie_duration, False, 0), media)
+
+    @staticmethod
+    def _time_to_sample(durations):
+        entries = []
+        for duration in durations:
+            if entries and entries[-1][1] == duration:
+                entries[-1][0] += 1
+            else:
+                entries.append([1, duration])
+        return full_box(b'stts', 0, 0, struct.pack('>I', len(entries)),
+                        big_endian([value for entry in entries for value in entry], 'I'))
+
+    @staticmethod
+    def _chunk_map(entries):
+        return full_box(b'stsc', 0, 0, struct.pack('>I', len(entries)),
+                        b''.join(struct.pack('>III', first_chunk, samples, 1) for first_chunk, samples in entries))
+
+    @staticmethod
+    def _chunk_offsets(offsets):
+        if offsets and max(offsets) > 0xFFFFFFFF:
+            return full_box(b'co64', 0, 0, struct.pack('>I', len(offsets)), big_endian(offsets, 'Q'))
+        return full_box(b'stco', 0, 0, struct.pack('>I', len(offsets)), big_endian(offsets, 'I'))
+
+    def _user_data(self):
+        """Nero章节（chpl，时间单位100纳秒）和iTunes元数据（书名、作者）"""
+        frame_samples = samples_per_frame(self.first_frame)
+        sample_rate = frame_sample_rate(self.first_frame)
+        chapters = b''
+        for chapter_title, start in list(zip(self.titles, self.frames))[:self.NERO_CHAPTERS]:
+            encoded = utf8_truncate(chapter_title, 255)
+            chapters += struct.pack('>QB', start * frame_samples * 10_000_000 // sample_rate, len(encoded)) + encoded
+        children = [full_box(b'chpl', 1, 0, struct.pack('>IB', 0, min(len(self.titles), self.NERO_CHAPTERS)),
+                             chapters)]
+        items = []
+        for kind, value in ((b'\xa9nam', self.title), (b'\xa9alb', self.title), (b'\xa9ART', self.author)):
+            if value:
+                items.append(box(kind, box(b'data', struct.pack('>II', 1, 0), value.encode('utf-8'))))
+        if items:
+            handler = full_box(b'hdlr', 0, 0, struct.pack('>I4s4s8x', 0, b'mdir', b'appl'), b'\x00')
+            children.append(full_box(b'meta', 0, 0, handler, box(b'ilst', *items)))
+        return box(b'udta', *children)
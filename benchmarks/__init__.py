@@ -0,0 +1 @@
+"""离线基准测试：合成EPUB生成器、本地模拟TTS后端和测试场景，在仓库根目录运行 python -m benchmarks.run_benchmarks"""
@@ -0,0 +1,75 @@
+"""本地模拟TTS服务：可配置延迟、抖动、错误率、并发上限和吞吐上限，返回真实可拼接的MP3帧"""
+import asyncio
+import random
+import time
+
+from tts_backends import TTSBackend
+
+# 与edge_tts输出相同的格式：MPEG2 Layer III，24kHz，48kbps，单声道，每帧144字节、24毫秒
+FRAME_HEADER = bytes([0xFF, 0xF3, 0x64, 0xC4])
+FRAME_SIZE = 144
+FRAME_SECONDS = 576 / 24000
+
+
+class FakeServiceError(Exception):
+    pass
+
+
+class FakeTTSService(TTSBackend):
+    """模拟的TTS服务（实现TTS后端接口），所有请求共用一组限制
+
+    latency + per_char * 字数为单次请求的基础延迟，再乘以(1 ± jitter)的随机因子；
+    超过max_concurrent的请求立即失败（模拟429），chars_per_second限制整体合成速度（请求排队变慢）
+    """
+
+    name = "fake"
+    output_format = "fake/audio-24khz-48kbitrate-mono-mp3"
+    default_voice = "fake-voice"
+
+    def __init__(self, latency=0.2, per_char=0.0002, jitter=0.2, error_rate=0.0, max_concurrent=None,
+                 chars_per_second=None, seconds_per_char=0.25, seed=0):
+        self.latency = latency
+        self.per_char = per_char
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_concurrent = max_concurrent
+        self.chars_per_second = chars_per_second
+        self.seconds_per_char = seconds_per_char  # 每个字生成多少秒音频
+        self.random = random.Random(seed)
+        self.inflight = 0
+        self.peak_inflight = 0
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self._next_free = 0.0  # 吞吐上限下，服务空闲的时间点
+
+    def audio_for(self, text):
+        frames = max(1, round(len(text) * self.seconds_per_char / FRAME_SECONDS))
+        payload = (text.encode('utf-8') * (FRAME_SIZE // max(len(text), 1) + 1))[:FRAME_SIZE - 4]
+        return (FRAME_HEADER + payload) * frames
+
+    async def synthesize(self, text, voice=None, rate="+0%", volume="+0%", pitch="+0Hz"):
+        self.requests += 1
+        if self.max_concurrent and self.inflight >= self.max_concurrent:
+            self.rejected += 1
+            raise FakeServiceError("429 Too Many Requests")
+        self.inflight += 1
+        self.peak_inflight = max(self.peak_inflight, self.inflight)
+        try:
+            delay = (self.latency + self.per_char * len(text)) * (1 + self.random.uniform(-self.jitter, self.jitter))
+            if self.chars_per_second:
+                now = time.monotonic()
+                start = max(now, self._next_free)
+                self._next_free = start + len(text) / self.chars_per_second
+                delay = max(delay, self._next_free - now)
+            await asyncio.sleep(delay)
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                raise FakeServiceError("模拟的服务错误")
+            return self.audio_for(text)
+        finally:
+            self.inflight -= 1
+
+    def stats(self):
+        return {"requests": self.requests, "errors": self.errors, "rejected": self.rejected,
+                "peak_inflight": self.peak_inflight}
@@ -0,0 +1,65 @@
+"""启动时间预算：在新的解释器中导入入口模块，检查导入耗时和是否提前导入了重的依赖
+
+    python -m benchmarks.import_time                 # 检查main和cli
+    python -m benchmarks.import_time --budget 0.2 -v  # 更严格的预算，并列出最慢的模块
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# 入口模块 -> 启动时不应导入的模块（只在合成、用lxml解析或pydub合并时才需要）
+ENTRY_POINTS = {
+    "main": ("edge_tts", "aiohttp", "pydub", "lxml", "bs4", "job_queue", "epub_converter"),
+    "cli": ("edge_tts", "aiohttp", "pydub", "lxml", "bs4"),
+}
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module, heavy):
+    """返回(总导入耗时秒数, [(自身耗时秒数, 模块名)], 已导入的重依赖)"""
+    code = (f"import sys; import {module}; "
+            f"print(','.join(m for m in {heavy!r} if m in sys.modules))")
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT,
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+    total = 0
+    modules = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        name = name[1:]  # 分隔符后有一个空格，嵌套的导入再按层级缩进
+        modules.append((int(self_us) / 1e6, name.strip()))
+        if not name.startswith(" "):  # 顶层导入，累计耗时不重复计算
+            total += int(cumulative_us)
+    loaded = [name for name in completed.stdout.strip().split(",") if name]
+    return total / 1e6, sorted(modules, reverse=True), loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="检查入口模块的导入耗时")
+    parser.add_argument("--budget", type=float, default=0.3, help="每个入口模块的导入耗时上限（秒）")
+    parser.add_argument("--runs", type=int, default=3, help="运行次数，取最小值（排除磁盘缓存的影响）")
+    parser.add_argument("-v", "--verbose", action="store_true", help="列出自身耗时最长的模块")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module, heavy in ENTRY_POINTS.items():
+        results = [measure(module, heavy) for _ in range(args.runs)]
+        total, modules, loaded = min(results, key=lambda result: result[0])
+        over = total > args.budget
+        print(f"{module:<8}{total * 1000:>8.1f} ms  (预算 {args.budget * 1000:.0f} ms){'  超出预算' if over else ''}")
+        if loaded:
+            print(f"  启动时导入了: {', '.join(loaded)}")
+        if args.verbose:
+            for seconds, name in modules[:10]:
+                print(f"  {seconds * 1000:>8.1f} ms  {name}")
+        failed = failed or over or bool(loaded)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
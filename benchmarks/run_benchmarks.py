@@ -0,0 +1,262 @@
+"""基准测试场景：用合成EPUB和模拟TTS服务测量convert_selected_chapters的耗时、吞吐和内存峰值
+
+每个场景在独立的子进程中运行，内存峰值互不影响。结果保存在benchmarks/results中，
+并与上一次（或--baseline指定）的结果比较，耗时或吞吐变差超过阈值时标记为退步。
+
+    python -m benchmarks.run_benchmarks                  # 全部场景
+    python -m benchmarks.run_benchmarks -s many-file --scale 0.2
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from benchmarks.fake_tts import FakeTTSService
+from benchmarks.synthetic_epub import generate
+from epub_converter import EpubToTTS
+from text_chunker import split_text
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# book: 合成EPUB参数；service: 模拟服务参数；concurrency: None为自动调整；runs: 运行次数，只统计最后一次；
+# expect_fewer_requests: 请求数必须少于各章直接分段后不同段的个数（重复段落被拆出并只合成一次），否则场景失败
+SCENARIOS = {
+    "many-file": {
+        "book": {"chapters": 40, "chars_per_chapter": 8000, "layout": "many-file"},
+        "service": {"latency": 0.15},
+    },
+    "filepos-single-file": {
+        "book": {"chapters": 40, "chars_per_chapter": 8000, "layout": "filepos"},
+        "service": {"latency": 0.15},
+    },
+    "anchors-single-file": {
+        "book": {"chapters": 40, "chars_per_chapter": 8000, "layout": "anchors"},
+        "service": {"latency": 0.15},
+    },
+    "many-small-chapters": {
+        "book": {"chapters": 400, "chars_per_chapter": 300, "layout": "many-file"},
+        "service": {"latency": 0.15},
+    },
+    "slow-jittery-service": {
+        "book": {"chapters": 20, "chars_per_chapter": 8000, "layout": "many-file"},
+        "service": {"latency": 0.8, "jitter": 0.6},
+    },
+    "error-prone-service": {
+        "book": {"chapters": 20, "chars_per_chapter": 8000, "layout": "many-file"},
+        "service": {"latency": 0.15, "error_rate": 0.03},
+    },
+    "capped-service": {
+        "book": {"chapters": 20, "chars_per_chapter": 8000, "layout": "many-file"},
+        "service": {"latency": 0.15, "max_concurrent": 4, "chars_per_second": 40000},
+    },
+    "fixed-concurrency": {
+        "book": {"chapters": 40, "chars_per_chapter": 8000, "layout": "many-file"},
+        "service": {"latency": 0.15},
+        "concurrency": 6,
+    },
+    "repeated-boilerplate": {
+        # 每章末尾有相同的约800字，应只合成一次；直接分段时它和正文结尾混在同一段里，只能偶尔整段相同
+        "book": {"chapters": 40, "chars_per_chapter": 2000, "layout": "many-file", "boilerplate_chars": 800},
+        "service": {"latency": 0.15},
+        "expect_fewer_requests": True,
+    },
+    "cached-rerun": {
+        "book": {"chapters": 40, "chars_per_chapter": 8000, "layout": "many-file"},
+        "service": {"latency": 0.15},
+        "runs": 2,
+    },
+}
+
+# 比较时检查的指标：(名称, 越大越好)
+COMPARED = [("makespan", False), ("chars_per_second", True), ("peak_rss_mb", False)]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def scaled_book(book, scale):
+    """按比例缩放章节数和每章字数
+
+    有重复段落的书只缩放章节数：正文和重复段落的长度决定重复段落能否单独成段
+    """
+    book = dict(book)
+    if book.get("boilerplate_chars"):
+        book["chapters"] = max(2, round(book["chapters"] * scale))
+        return book
+    book["chapters"] = max(1, round(book["chapters"] * scale))
+    book["chars_per_chapter"] = max(100, round(book["chars_per_chapter"] * scale))
+    return book
+
+
+def run_scenario(name, scale, workdir):
+    """在当前进程中运行一个场景，返回结果"""
+    scenario = SCENARIOS[name]
+    book = scaled_book(scenario["book"], scale)
+    epub_path = os.path.join(workdir, "book.epub")
+    output_dir = os.path.join(workdir, "output")
+    total_chars = generate(epub_path, **book)
+
+    for run in range(scenario.get("runs", 1)):
+        if run:
+            # 重复运行时删除已生成的章节和转换日志，只保留合成缓存
+            os.remove(os.path.join(output_dir, ".conversion_journal.db"))
+            for path in glob.glob(os.path.join(output_dir, "*.mp3")):
+                os.remove(path)
+        service = FakeTTSService(**scenario["service"])
+        converter = EpubToTTS(epub_path, output_dir, backend=service)
+        started = time.perf_counter()
+        chapters = converter.get_toc_structure()
+        asyncio.run(converter.convert_selected_chapters(chapters, lambda *args: None, scenario.get("concurrency")))
+        makespan = time.perf_counter() - started
+        plain_chunks = len({chunk for chapter in chapters
+                            for chunk in split_text(converter.book.chapter_text(chapter['href']), converter.chunk_size)})
+        converter.book.close()
+
+    if scenario.get("expect_fewer_requests") and service.requests >= plain_chunks:
+        raise RuntimeError(f"请求数 {service.requests} 没有少于直接分段的段数 {plain_chunks}")
+
+    summary = converter.metrics.summary()
+    tts = summary["stages"].get("tts_request", {})
+    return {
+        "book": book,
+        "service": scenario["service"],
+        "chars": total_chars,
+        "chapters": len(chapters),
+        "makespan": round(makespan, 3),
+        "chars_per_second": round(total_chars / makespan, 1),
+        "audio_seconds": summary["audio_seconds"],
+        "realtime_factor": round(summary["audio_seconds"] / makespan, 2),
+        "tts_p50": tts.get("p50"),
+        "tts_p95": tts.get("p95"),
+        "tts_p99": tts.get("p99"),
+        "counters": summary["counters"],
+        "service_stats": service.stats(),
+        "plain_chunks": plain_chunks,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_in_subprocess(name, scale):
+    """在子进程中运行场景，内存峰值只属于这一个场景"""
+    command = [sys.executable, "-m", "benchmarks.run_benchmarks", "--child", name, "--scale", str(scale)]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    completed = subprocess.run(command, cwd=root, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "失败"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def latest_result(exclude=None):
+    paths = sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")))
+    paths = [path for path in paths if path != exclude]
+    return paths[-1] if paths else None
+
+
+def compare(current, baseline, threshold):
+    """打印与基线的对比，返回退步的(场景, 指标)列表"""
+    regressions = []
+    print(f"{'场景':<24}{'指标':<18}{'基线':>12}{'本次':>12}{'变化':>10}")
+    for name, result in current["scenarios"].items():
+        old = baseline["scenarios"].get(name)
+        if not old or "error" in old or "error" in result:
+            continue
+        for metric, higher_is_better in COMPARED:
+            before, after = old.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            flag = "  退步" if worse > threshold else ""
+            if flag:
+                regressions.append((name, metric))
+            print(f"{name:<24}{metric:<18}{before:>12}{after:>12}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EPUB转TTS离线基准测试")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS), help="只运行指定场景，可重复")
+    parser.add_argument("--scale", type=float, default=1.0, help="按比例缩放书籍规模，如0.1用于快速检查")
+    parser.add_argument("--baseline", help="用于比较的结果文件，默认为上一次的结果")
+    parser.add_argument("--threshold", type=float, default=0.10, help="变差超过该比例时标记为退步")
+    parser.add_argument("--no-save", action="store_true", help="不保存本次结果")
+    parser.add_argument("--fail-on-regression", action="store_true", help="有退步时返回非0")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        logging.basicConfig(level=logging.WARNING)
+        workdir = tempfile.mkdtemp(prefix="epub_tts_bench_")
+        try:
+            print(json.dumps(run_scenario(args.child, args.scale, workdir), ensure_ascii=False))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return 0
+
+    current = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "scenarios": {},
+    }
+    for name in args.scenario or SCENARIOS:
+        print(f"运行场景: {name} ...", flush=True)
+        result = run_in_subprocess(name, args.scale)
+        current["scenarios"][name] = result
+        if "error" in result:
+            print(f"  失败: {result['error']}")
+        else:
+            print(f"  用时 {result['makespan']} 秒, {result['chars_per_second']} 字/秒, "
+                  f"{result['realtime_factor']} 倍实时, 内存峰值 {result['peak_rss_mb']} MB, "
+                  f"请求 {result['service_stats']['requests']} 次 (直接分段 {result['plain_chunks']} 种)")
+
+    saved = None
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        saved = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{current['commit'] or 'local'}.json")
+        with open(saved, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {saved}")
+
+    baseline_path = args.baseline or latest_result(exclude=saved)
+    regressions = []
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get("scale") != args.scale:
+            print(f"基线的规模({baseline.get('scale')})与本次不同，比较结果仅供参考")
+        print(f"与基线比较: {baseline_path}")
+        regressions = compare(current, baseline, args.threshold)
+    failed = [name for name, result in current["scenarios"].items() if "error" in result]
+    return 1 if failed or (regressions and args.fail_on_regression) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
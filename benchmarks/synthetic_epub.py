@@ -0,0 +1,154 @@
+"""生成指定规模的合成EPUB，用于基准测试
+
+布局:
+  many-file  每章一个XHTML文件，目录用toc.ncx和EPUB3 nav.xhtml
+  filepos    所有章节在一个HTML文件中，目录用#fileposN定位（常见于由MOBI转换的书）
+  anchors    所有章节在一个XHTML文件中，目录用#id定位
+"""
+import argparse
+import random
+import zipfile
+from xml.sax.saxutils import escape
+
+LAYOUTS = ('many-file', 'filepos', 'anchors')
+
+# 常用汉字，随机组合成句子；混入少量西文句子覆盖中西文标点
+HANZI = ("的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多"
+         "定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政"
+         "四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严")
+CN_PUNCT = "，，，、；：。。。！？"
+WESTERN = ["The quick brown fox jumps over the lazy dog.", "Is this the real life?", "\"Yes,\" she said.",
+           "It costs 3.14 dollars; that's fine!"]
+
+
+def make_sentence(rng):
+    words = []
+    for _ in range(rng.randint(2, 6)):
+        words.append(''.join(rng.choice(HANZI) for _ in range(rng.randint(3, 9))))
+        words.append(rng.choice(CN_PUNCT[:5]))
+    words[-1] = rng.choice(CN_PUNCT[5:])
+    if rng.random() < 0.05:
+        words.append(rng.choice(WESTERN))
+    return ''.join(words)
+
+
+def make_paragraphs(rng, chars):
+    """生成总长度约为chars字符的段落列表"""
+    paragraphs = []
+    total = 0
+    while total < chars:
+        paragraph = ''.join(make_sentence(rng) for _ in range(rng.randint(2, 8)))
+        paragraphs.append(paragraph)
+        total += len(paragraph)
+    return paragraphs
+
+
+def chapter_html(index, paragraphs, anchor=None):
+    anchor_attr = f' id="{anchor}"' if anchor else ''
+    body = ''.join(f'<p>{escape(p)}</p>\n' for p in paragraphs)
+    return f'<h1{anchor_attr}>第{index + 1}章</h1>\n{body}'
+
+
+def document(body):
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>章节</title>'
+            '<style>p { text-indent: 2em; }</style></head>\n<body>\n' + body + '</body></html>')
+
+
+def ncx(entries):
+    points = ''.join(
+        f'<navPoint id="n{i}" playOrder="{i + 1}"><navLabel><text>{escape(title)}</text></navLabel>'
+        f'<content src="{src}"/></navPoint>\n' for i, (title, src) in enumerate(entries))
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1"><head/>'
+            '<docTitle><text>合成测试书</text></docTitle><navMap>\n' + points + '</navMap></ncx>')
+
+
+def nav(entries):
+    items = ''.join(f'<li><a href="{src}">{escape(title)}</a></li>\n' for title, src in entries)
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops"><body>'
+            '<nav epub:type="toc"><ol>\n' + items + '</ol></nav></body></html>')
+
+
+def opf(documents):
+    items = ''.join(f'<item id="d{i}" href="{name}" media-type="application/xhtml+xml"/>'
+                    for i, name in enumerate(documents))
+    spine = ''.join(f'<itemref idref="d{i}"/>' for i in range(len(documents)))
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>合成测试书</dc:title>'
+            '<dc:language>zh</dc:language><dc:identifier id="id">synthetic</dc:identifier></metadata>'
+            '<manifest><item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+            '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+            + items + '</manifest><spine toc="ncx">' + spine + '</spine></package>')
+
+
+def generate(path, chapters=20, chars_per_chapter=5000, layout='many-file', seed=0, boilerplate_chars=0):
+    """生成合成EPUB，返回正文总字符数
+
+    boilerplate_chars大于0时，每章末尾加上同样的约boilerplate_chars字（模拟网络小说的版权声明和译者注）
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"未知的布局: {layout}")
+    rng = random.Random(seed)
+    contents = [make_paragraphs(rng, chars_per_chapter) for _ in range(chapters)]
+    if boilerplate_chars:
+        footer = make_paragraphs(random.Random(seed + 1), boilerplate_chars)
+        contents = [paragraphs + footer for paragraphs in contents]
+    total_chars = sum(len(p) for paragraphs in contents for p in paragraphs)
+
+    files = {}
+    entries = []
+    if layout == 'many-file':
+        for i, paragraphs in enumerate(contents):
+            name = f'Text/chapter{i + 1:04d}.xhtml'
+            files[name] = document(chapter_html(i, paragraphs))
+            entries.append((f'第{i + 1}章', name))
+    else:
+        # 先拼出整个文档，再根据每章开头在源文件中的字符位置生成#filepos锚点
+        head = document('')[:-len('</body></html>')]
+        parts = [head]
+        offsets = []
+        position = len(head)
+        for i, paragraphs in enumerate(contents):
+            offsets.append(position)
+            part = chapter_html(i, paragraphs, anchor=f'c{i + 1}' if layout == 'anchors' else None)
+            parts.append(part)
+            position += len(part)
+        parts.append('</body></html>')
+        name = 'Text/book.xhtml'
+        files[name] = ''.join(parts)
+        for i, offset in enumerate(offsets):
+            fragment = f'filepos{offset}' if layout == 'filepos' else f'c{i + 1}'
+            entries.append((f'第{i + 1}章', f'{name}#{fragment}'))
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip')
+        z.writestr('META-INF/container.xml',
+                   '<?xml version="1.0"?><container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" '
+                   'version="1.0"><rootfiles><rootfile full-path="OEBPS/content.opf" '
+                   'media-type="application/oebps-package+xml"/></rootfiles></container>')
+        z.writestr('OEBPS/content.opf', opf(sorted(files)))
+        z.writestr('OEBPS/toc.ncx', ncx(entries))
+        z.writestr('OEBPS/nav.xhtml', nav(entries))
+        for name, content in files.items():
+            z.writestr(f'OEBPS/{name}', content)
+    return total_chars
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生成合成EPUB")
+    parser.add_argument("path")
+    parser.add_argument("--chapters", type=int, default=20)
+    parser.add_argument("--chars", type=int, default=5000, help="每章字符数")
+    parser.add_argument("--layout", choices=LAYOUTS, default='many-file')
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--boilerplate", type=int, default=0, help="每章末尾相同段落的字符数")
+    args = parser.parse_args(argv)
+    total = generate(args.path, args.chapters, args.chars, args.layout, args.seed, args.boilerplate)
+    print(f"{args.path}: {args.chapters} 章, {total} 字")
+
+
+if __name__ == "__main__":
+    main()
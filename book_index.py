@@ -0,0 +1,444 @@
+import bisect
+import importlib.util
+import logging
+import os
+import posixpath
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+from html.parser import HTMLParser
+from urllib.parse import unquote
+
+from metrics import Metrics
+
+# lxml在第一次用它解析文档时才导入，打开书籍和读取目录不需要
+LXML_AVAILABLE = importlib.util.find_spec("lxml") is not None
+
+NS = {
+    'container': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'opf': 'http://www.idpf.org/2007/opf',
+    'ncx': 'http://www.daisy.org/z3986/2005/ncx/',
+    'xhtml': 'http://www.w3.org/1999/xhtml',
+    'epub': 'http://www.idpf.org/2007/ops',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+}
+
+
+def qname(prefix, tag):
+    return f"{{{NS[prefix]}}}{tag}"
+
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+logger = logging.getLogger(__name__)
+
+
+class TextSegmentParser(HTMLParser):
+    """一次遍历HTML，记录每个文本节点在源文件中的位置和带id元素的位置"""
+
+    SKIP_TAGS = ('script', 'style')
+
+    def __init__(self, content):
+        super().__init__(convert_charrefs=True)
+        self.line_starts = [0] + [m.end() for m in re.finditer('\n', content)]
+        self.offsets = []
+        self.texts = []
+        self.ids = {}
+        self.skip_depth = 0
+
+    def position(self):
+        line, column = self.getpos()
+        return self.line_starts[line - 1] + column
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        for name, value in attrs:
+            if name == 'id' and value:
+                self.ids.setdefault(value, self.position())
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.offsets.append(self.position())
+            self.texts.append(data)
+
+
+def decode_document(raw):
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw.decode('utf-8', errors='replace')
+
+
+def parse_document(raw, backend='html.parser'):
+    """解析文档，返回(文本节点偏移列表, 文本节点列表, id -> 偏移, 文档长度)
+
+    html.parser后端的偏移是源文件中的字符位置，可以定位#filepos锚点；
+    lxml后端更快，但偏移只是文本节点的顺序号，只能用于#id锚点
+    """
+    if backend == 'lxml':
+        return parse_document_lxml(raw)
+    content = decode_document(raw)
+    parser = TextSegmentParser(content)
+    parser.feed(content)
+    parser.close()
+    return parser.offsets, parser.texts, parser.ids, len(content)
+
+
+def parse_document_lxml(raw):
+    from lxml import html as lxml_html
+    root = lxml_html.document_fromstring(raw, parser=lxml_html.HTMLParser(encoding='utf-8'))
+    texts = []
+    ids = {}
+    # 深度优先遍历：元素的text在子元素之前，tail在整个子树之后
+    stack = [(root, False, False)]
+    while stack:
+        element, skip, is_tail = stack.pop()
+        if is_tail:
+            if element.tail and not skip:
+                texts.append(element.tail)
+            continue
+
+        if isinstance(element.tag, str):
+            if element.get('id'):
+                ids.setdefault(element.get('id'), len(texts))
+            child_skip = skip or element.tag in TextSegmentParser.SKIP_TAGS
+            if element.text and not child_skip:
+                texts.append(element.text)
+        else:
+            child_skip = True  # 注释和处理指令的内容不是正文
+        for child in reversed(element):
+            stack.append((child, child_skip, True))
+            stack.append((child, child_skip, False))
+    return list(range(len(texts))), texts, ids, len(texts)
+
+
+_worker_zips = {}
+
+
+def parse_epub_document(epub_path, path, backend):
+    """在进程池中执行：读取并解析EPUB中的一个文档，每个进程只打开一次压缩包
+
+    返回(解析结果, [(阶段, 开始时间, 耗时, 进程号)])，耗时由主进程合并到统计中
+    """
+    if epub_path not in _worker_zips:
+        _worker_zips[epub_path] = zipfile.ZipFile(epub_path, 'r')
+    read_start = time.perf_counter()
+    raw = _worker_zips[epub_path].read(path)
+    parse_start = time.perf_counter()
+    parsed = parse_document(raw, backend)
+    parse_end = time.perf_counter()
+    pid = os.getpid()
+    return parsed, [("zip_read", read_start, parse_start - read_start, pid),
+                    ("html_parse", parse_start, parse_end - parse_start, pid)]
+
+
+def normalize_whitespace(text):
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+class BookIndex:
+    """EPUB书籍索引：只打开一次压缩包，读取OPF清单和spine，每个内容文档最多解码和解析一次"""
+
+    def __init__(self, epub_path):
+        self.epub_path = epub_path
+        self.zip = zipfile.ZipFile(epub_path, 'r')
+        self.names = set(self.zip.namelist())
+        self.opf_path = None
+        self.manifest = {}  # id -> (压缩包内路径, media-type)
+        self.spine = []  # 压缩包内路径，按阅读顺序
+        self.toc_id = None
+        self.nav_path = None  # EPUB3导航文档
+        self.title = None  # OPF元数据中的书名和作者
+        self.author = None
+        self.identifier = None  # OPF中unique-identifier指向的dc:identifier，用于区分同一输出目录中的不同书籍
+        self._chapters = None
+        self._documents = {}  # 路径 -> parse_document的结果
+        self._texts = {}  # (路径, 起点, 终点) -> 文本
+        self._anchors = {}  # 路径 -> 目录中指向该文档的锚点
+        self._anchor_positions = {}  # 路径 -> 锚点位置（已排序）
+        self._lengths = {}  # 路径 -> 解码后的文档长度（估算章节长度用）
+        self._lock = threading.RLock()
+        self.metrics = Metrics(enabled=False)  # 转换时替换为本次运行的统计
+        self._read_opf()
+
+    def close(self):
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def resolve(self, base_path, href):
+        """把相对于base_path的链接解析为压缩包内路径（保留#锚点）"""
+        href, _, fragment = unquote(href).partition('#')
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(base_path), href)) if href else base_path
+        return f"{path}#{fragment}" if fragment else path
+
+    def _iterparse(self, path, events=('end',)):
+        """流式解析压缩包中的XML，大文件也不需要一次读入和建完整的树"""
+        with self.zip.open(path) as f:
+            yield from ET.iterparse(f, events)
+
+    def _read_opf(self):
+        """通过container.xml找到OPF，流式读取清单和spine"""
+        if 'META-INF/container.xml' in self.names:
+            try:
+                for _, elem in self._iterparse('META-INF/container.xml'):
+                    if elem.tag == qname('container', 'rootfile') and elem.get('full-path') in self.names:
+                        self.opf_path = elem.get('full-path')
+                        break
+            except ET.ParseError as e:
+                logger.warning("container.xml解析失败: %s", e)
+        if self.opf_path is None:
+            self.opf_path = next((name for name in sorted(self.names) if name.endswith('.opf')), None)
+        if self.opf_path is None:
+            return
+
+        itemrefs = []
+        unique_id = None
+        identifiers = []  # (id属性, 文本)
+        try:
+            for event, elem in self._iterparse(self.opf_path, ('start', 'end')):
+                if event == 'start':
+                    if elem.tag == qname('opf', 'spine'):
+                        self.toc_id = elem.get('toc')
+                    elif elem.tag == qname('opf', 'package'):
+                        unique_id = elem.get('unique-identifier')
+                    continue
+                if elem.tag == qname('opf', 'item'):
+                    path = self.resolve(self.opf_path, elem.get('href', ''))
+                    self.manifest[elem.get('id')] = (path, elem.get('media-type', ''))
+                    if 'nav' in elem.get('properties', '').split():
+                        self.nav_path = path
+                elif elem.tag == qname('opf', 'itemref'):
+                    itemrefs.append(elem.get('idref'))
+                elif elem.tag == qname('dc', 'title') and not self.title:
+                    self.title = normalize_whitespace(elem.text or '') or None
+                elif elem.tag == qname('dc', 'creator') and not self.author:
+                    self.author = normalize_whitespace(elem.text or '') or None
+                elif elem.tag == qname('dc', 'identifier') and (elem.text or '').strip():
+                    identifiers.append((elem.get('id'), elem.text.strip()))
+                elem.clear()
+        except ET.ParseError as e:
+            logger.warning("OPF解析失败: %s", e)
+        if identifiers:
+            self.identifier = next((text for element_id, text in identifiers if element_id == unique_id), identifiers[0][1])
+        # spine可能写在清单之前，读完后再对应路径
+        for idref in itemrefs:
+            item = self.manifest.get(idref)
+            if item:
+                self.spine.append(item[0])
+
+    def find_ncx(self):
+        if self.toc_id in self.manifest:
+            return self.manifest[self.toc_id][0]
+        for path, media_type in self.manifest.values():
+            if media_type == 'application/x-dtbncx+xml':
+                return path
+        return next((name for name in sorted(self.names) if name.endswith('toc.ncx')), None)
+
+    def chapters(self):
+        """目录中的章节列表（按阅读顺序展开嵌套的目录），每项包含id（目录中的序号）、title、
+        href（压缩包内路径）和level（嵌套层级，从1开始）
+
+        依次使用NCX、EPUB3导航文档和spine：已有NCX时优先使用，保持与之前转换的文件名一致
+        """
+        with self._lock:
+            if self._chapters is None:
+                self._chapters = []
+                for read in (self._read_ncx, self._read_nav, self._read_spine):
+                    try:
+                        entries = read()
+                    except (ET.ParseError, KeyError) as e:
+                        logger.warning("读取目录失败(%s): %s", read.__name__, e)
+                        continue
+                    if entries:
+                        self._chapters = [
+                            {'id': i, 'title': f"{i + 1}.{title}", 'href': href, 'level': level}
+                            for i, (title, href, level) in enumerate(entries)
+                        ]
+                        break
+                self._index_anchors()
+            return self._chapters
+
+    def _read_ncx(self):
+        """流式读取NCX，返回[(标题, 链接, 层级)]"""
+        ncx_path = self.find_ncx()
+        logger.info("找到目录文件: %s", ncx_path)
+        if not ncx_path or ncx_path not in self.names:
+            return []
+
+        entries = []
+        labels = []  # 每层navPoint的标题
+        for event, elem in self._iterparse(ncx_path, ('start', 'end')):
+            if elem.tag == qname('ncx', 'navPoint'):
+                if event == 'start':
+                    labels.append(None)
+                else:
+                    labels.pop()
+                    elem.clear()
+            elif event == 'end' and labels:
+                if elem.tag == qname('ncx', 'text') and labels[-1] is None:
+                    labels[-1] = elem.text or ''
+                elif elem.tag == qname('ncx', 'content') and labels[-1] is not None:
+                    entries.append((labels[-1], self.resolve(ncx_path, elem.get('src', '')), len(labels)))
+        return entries
+
+    def _read_nav(self):
+        """流式读取EPUB3导航文档中epub:type="toc"的nav，返回[(标题, 链接, 层级)]"""
+        if not self.nav_path or self.nav_path not in self.names:
+            return []
+        logger.info("找到导航文档: %s", self.nav_path)
+
+        entries = []
+        in_toc = False
+        depth = 0  # ol的嵌套层数
+        for event, elem in self._iterparse(self.nav_path, ('start', 'end')):
+            tag = local_name(elem.tag)
+            if tag == 'nav':
+                if event == 'start':
+                    in_toc = 'toc' in elem.get(qname('epub', 'type'), '').split()
+                elif in_toc:
+                    break
+            elif not in_toc:
+                if event == 'end':
+                    elem.clear()
+            elif tag == 'ol':
+                depth += 1 if event == 'start' else -1
+            elif tag == 'a' and event == 'end' and elem.get('href'):
+                title = normalize_whitespace(''.join(elem.itertext()))
+                entries.append((title, self.resolve(self.nav_path, elem.get('href')), depth))
+        return entries
+
+    def _read_spine(self):
+        """没有目录时每个spine文档作为一章，标题用文件名"""
+        if self.spine:
+            logger.info("没有找到目录，按spine生成 %d 个章节", len(self.spine))
+        return [(posixpath.splitext(posixpath.basename(path))[0], path, 1)
+                for path in self.spine if path != self.nav_path]
+
+    def _index_anchors(self):
+        """记录每个文档中被目录引用的锚点，用于确定章节的结束位置"""
+        for chapter in self._chapters:
+            path, _, fragment = chapter['href'].partition('#')
+            self._anchors.setdefault(path, set()).add(fragment)
+
+    def backend_for(self, path):
+        """选择解析后端：目录用#filepos定位的文档需要字符位置，只能用html.parser"""
+        if not LXML_AVAILABLE:
+            return 'html.parser'
+        self.chapters()
+        if any(anchor.startswith('filepos') for anchor in self._anchors.get(path, ())):
+            return 'html.parser'
+        return 'lxml'
+
+    def estimated_size(self, href):
+        """转换前估算章节的工作量（字节）：取压缩包目录中文档的原始大小，
+        多个章节共用一个文档时按锚点范围分摊（文档未解析且锚点不是#filepos时平均分摊）"""
+        path, _, fragment = href.partition('#')
+        try:
+            size = self.zip.getinfo(path).file_size
+        except KeyError:
+            return 0
+        self.chapters()
+        anchors = self._anchors.get(path, ())
+        if len(anchors) <= 1:
+            return size
+
+        if self.has_document(path):
+            length = self.document(path)[3]
+        elif all(anchor.startswith('filepos') for anchor in anchors if anchor):
+            # #filepos锚点是源文件中的字符位置，只需解码不需要解析
+            with self._lock:
+                if path not in self._lengths:
+                    self._lengths[path] = len(decode_document(self.zip.read(path)))
+            length = self._lengths[path]
+        else:
+            return size // len(anchors)
+        start = self.anchor_position(path, fragment)
+        if start is None:
+            return size // len(anchors)
+        positions = self.anchor_positions(path)
+        next_index = bisect.bisect_right(positions, start)
+        end = positions[next_index] if next_index < len(positions) else length
+        return size * max(end - start, 0) // max(length, 1)
+
+    def has_document(self, path):
+        with self._lock:
+            return path in self._documents
+
+    def set_document(self, path, parsed):
+        """登记在其他进程中解析好的文档"""
+        with self._lock:
+            self._documents.setdefault(path, parsed)
+
+    def document(self, path):
+        """解码并解析内容文档，结果缓存"""
+        with self._lock:
+            if path not in self._documents:
+                with self.metrics.span("zip_read", path=path):
+                    raw = self.zip.read(path)
+                logger.debug("解析文档: %s, 长度: %d 字节", path, len(raw))
+                with self.metrics.span("html_parse", path=path):
+                    self._documents[path] = parse_document(raw, self.backend_for(path))
+            return self._documents[path]
+
+    def anchor_position(self, path, fragment):
+        """锚点在文档中的位置：支持#fileposN和#id，找不到时返回None"""
+        if not fragment:
+            return 0
+        if fragment.startswith('filepos'):
+            try:
+                return int(fragment[len('filepos'):])
+            except ValueError:
+                return None
+        return self.document(path)[2].get(fragment)
+
+    def anchor_positions(self, path):
+        """目录中指向该文档的所有锚点位置（已排序）"""
+        self.chapters()
+        with self._lock:
+            if path not in self._anchor_positions:
+                positions = {self.anchor_position(path, anchor) for anchor in self._anchors.get(path, ())}
+                positions.discard(None)
+                self._anchor_positions[path] = sorted(positions)
+            return self._anchor_positions[path]
+
+    def chapter_text(self, href, next_href=None):
+        """提取章节文本：从章节锚点到下一个锚点（未指定时取目录中同一文档的下一个锚点）"""
+        path, _, fragment = href.partition('#')
+        offsets, texts, _, length = self.document(path)
+
+        start = self.anchor_position(path, fragment)
+        if start is None:
+            start = 0
+
+        end = length
+        if next_href is not None:
+            next_path, _, next_fragment = next_href.partition('#')
+            if next_path == path:
+                end = self.anchor_position(path, next_fragment)
+                end = length if end is None or end <= start else end
+        else:
+            positions = self.anchor_positions(path)
+            next_index = bisect.bisect_right(positions, start)
+            if next_index < len(positions):
+                end = positions[next_index]
+
+        key = (path, start, end)
+        with self._lock:
+            if key not in self._texts:
+                first = bisect.bisect_left(offsets, start)
+                last = bisect.bisect_left(offsets, end)
+                self._texts[key] = normalize_whitespace(''.join(texts[first:last]))
+            return self._texts[key]
@@ -0,0 +1,162 @@
+"""虚拟化的章节列表：Treeview中只保留可见的若干行，滚动时用数据模型重新填充
+
+选中状态保存在按章节id索引的bytearray中，转换状态保存在列表中，
+上万个目录项的书打开、全选和读取选中章节都不需要逐行访问Treeview。
+"""
+import tkinter as tk
+from tkinter import ttk
+
+CHECKED = "☑"
+UNCHECKED = "☐"
+
+
+class ChapterList:
+    """章节列表控件：双击切换选中，按住Shift单击把上次点击的章节到当前章节设为相同的选中状态"""
+
+    def __init__(self, parent, height=12):
+        self.frame = ttk.Frame(parent)
+        columns = ("选择", "章节", "状态")
+        self.tree = ttk.Treeview(self.frame, columns=columns, show="headings", height=height, selectmode="none")
+        for column, width in zip(columns, (60, 500, 100)):
+            self.tree.heading(column, text=column)
+            self.tree.column(column, width=width)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.on_scroll)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        # 样式中的行高只用于首次显示前的估算，有可见行后按实际显示的行高计算
+        style_height = ttk.Style().lookup("Treeview", "rowheight")
+        self.row_height = int(style_height) if style_height else 20
+        self.chapters = []
+        self.selected = bytearray()  # 章节id -> 1为选中
+        self.statuses = []  # 章节id -> 转换状态
+        self.offset = 0  # 第一行可见行对应的章节id
+        self.rows = []  # 可见行的Treeview项目
+        self.anchor = None  # 上次单独切换的章节，Shift单击时作为范围的起点
+
+        self.tree.bind("<Configure>", self.fit_rows)
+        self.tree.bind("<Double-1>", self.on_double_click)
+        self.tree.bind("<Shift-Button-1>", self.on_shift_click)
+        self.tree.bind("<MouseWheel>", self.on_wheel)
+        self.tree.bind("<Button-4>", lambda event: self.scroll_by(-3))
+        self.tree.bind("<Button-5>", lambda event: self.scroll_by(3))
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def load(self, chapters, status="待转换"):
+        """换成新的章节列表，默认全部选中"""
+        self.chapters = chapters
+        self.selected = bytearray(b"\x01") * len(chapters)
+        self.statuses = [status] * len(chapters)
+        self.offset = 0
+        self.anchor = None
+        self.render()
+
+    def fit_rows(self, event=None):
+        """按控件高度调整可见行数"""
+        top = self.row_height  # 表头高度，没有行时按一行估算
+        if self.rows:
+            box = self.tree.bbox(self.rows[0])
+            if box:
+                top, self.row_height = box[1], box[3]
+        count = max(1, (self.tree.winfo_height() - top) // self.row_height)
+        while len(self.rows) < count:
+            self.rows.append(self.tree.insert("", "end", values=("", "", "")))
+        while len(self.rows) > count:
+            self.tree.delete(self.rows.pop())
+        self.scroll_to(self.offset)
+
+    def render(self):
+        """用数据模型填充可见行，并同步滚动条"""
+        for row, index in enumerate(range(self.offset, self.offset + len(self.rows))):
+            self._render_row(row, index)
+        total = len(self.chapters)
+        if total:
+            self.scrollbar.set(self.offset / total, min(1.0, (self.offset + len(self.rows)) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def _render_row(self, row, index):
+        if index < len(self.chapters):
+            mark = CHECKED if self.selected[index] else UNCHECKED
+            values = (mark, self.chapters[index]['title'], self.statuses[index])
+        else:
+            values = ("", "", "")
+        self.tree.item(self.rows[row], values=values)
+
+    def scroll_to(self, offset):
+        self.offset = max(0, min(offset, len(self.chapters) - len(self.rows)))
+        self.render()
+
+    def scroll_by(self, rows):
+        self.scroll_to(self.offset + rows)
+        return "break"
+
+    def on_scroll(self, action, amount, unit=None):
+        """滚动条回调：moveto为比例，scroll为行数或页数"""
+        if action == "moveto":
+            self.scroll_to(round(float(amount) * len(self.chapters)))
+        elif action == "scroll":
+            step = len(self.rows) if unit == "pages" else 1
+            self.scroll_by(int(amount) * step)
+
+    def on_wheel(self, event):
+        return self.scroll_by(-3 if event.delta > 0 else 3)
+
+    def index_at(self, y):
+        """y坐标处的章节id，不是章节行时返回None"""
+        row = self.tree.identify_row(y)
+        if row not in self.rows:
+            return None
+        index = self.offset + self.rows.index(row)
+        return index if index < len(self.chapters) else None
+
+    def on_double_click(self, event):
+        index = self.index_at(event.y)
+        if index is not None:
+            self.set_selected(index, index, not self.selected[index])
+            self.anchor = index
+
+    def on_shift_click(self, event):
+        index = self.index_at(event.y)
+        if index is None:
+            return "break"
+        if self.anchor is None:
+            self.set_selected(index, index, not self.selected[index])
+            self.anchor = index
+        else:
+            self.set_selected(min(self.anchor, index), max(self.anchor, index), self.selected[self.anchor])
+        return "break"
+
+    def set_selected(self, first, last, selected):
+        """把章节first到last（含）设为选中或不选中"""
+        self.selected[first:last + 1] = (b"\x01" if selected else b"\x00") * (last - first + 1)
+        self.render()
+
+    def select_all(self):
+        if self.chapters:
+            self.set_selected(0, len(self.chapters) - 1, True)
+
+    def deselect_all(self):
+        if self.chapters:
+            self.set_selected(0, len(self.chapters) - 1, False)
+
+    def selected_chapters(self):
+        return [chapter for chapter, selected in zip(self.chapters, self.selected) if selected]
+
+    def set_status(self, index, status):
+        """更新一个章节的状态，只有可见时才访问Treeview"""
+        if index is None or not 0 <= index < len(self.statuses):
+            return
+        self.statuses[index] = status
+        row = index - self.offset
+        if 0 <= row < len(self.rows):
+            self.tree.set(self.rows[row], "状态", status)
+
+    def reset_selected_status(self, status):
+        """把选中章节的状态重置为status"""
+        for index, selected in enumerate(self.selected):
+            if selected:
+                self.statuses[index] = status
+        self.render()
@@ -0,0 +1,318 @@
+import asyncio
+import logging
+from collections import deque
+
+from metrics import Metrics
+from mp3_concat import Mp3Writer
+from subtitles import ChunkTiming
+
+logger = logging.getLogger(__name__)
+
+
+def call_in_loop(loop, func, *args):
+    """在指定的事件循环中执行，可从其他线程（如GUI线程）调用；事件循环未运行时不执行"""
+    if loop is None or loop.is_closed():
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        func(*args)
+    else:
+        loop.call_soon_threadsafe(func, *args)
+
+
+class ChapterJob:
+    """一个章节的合成任务：乱序完成的段先放入重排缓冲区，前面的段都写完后立即追加到章节文件"""
+
+    def __init__(self, output_file, chunks, keys, start_index=0, start_offset=0, on_written=None, metrics=None):
+        self.output_file = output_file
+        self.metrics = metrics or Metrics(enabled=False)
+        self.chunks = chunks
+        self.keys = keys
+        self.on_written = on_written  # (段索引, 写入后的文件长度)，用于记录续传位置
+        self.next_index = start_index
+        self.buffer = {}  # 段索引 -> (音频数据(bytes)、缓存文件路径(str)或None(失败), 词边界)
+        self.timings = []  # 本次写入的段在章节音频中的时间（ChunkTiming），用于生成字幕
+        self.written_count = start_index
+        self.failed_count = 0
+        self.futures = []
+        self.aborted = False
+
+        # 续传时保留已写入的部分，已有文件无法续写时从头开始
+        self.file = None
+        if start_offset:
+            self.file = open(output_file, 'r+b')
+            self.file.truncate(start_offset)
+            try:
+                self.writer = Mp3Writer(self.file, start_offset)
+            except ValueError as e:
+                logger.warning("无法续写 %s: %s", output_file, e)
+                self.file.close()
+                self.file = None
+        if self.file is None:
+            self.file = open(output_file, 'wb')
+            self.writer = Mp3Writer(self.file)
+            self.next_index = 0
+            self.written_count = 0
+        self.resumed_bytes = self.writer.position  # 续传保留的部分不计入本次运行的统计
+        self.resumed_seconds = self.writer.duration()
+
+    def complete(self, index, audio, boundaries=None):
+        """登记一个段的结果（以及词边界），并写出所有已连续完成的段"""
+        if self.aborted:
+            return
+        self.buffer[index] = (audio, boundaries)
+        while self.next_index in self.buffer:
+            audio, boundaries = self.buffer.pop(self.next_index)
+            start = self.writer.duration()
+            try:
+                with self.metrics.span("merge"):
+                    if isinstance(audio, str):
+                        self.writer.append_file(audio)
+                    elif audio is not None:
+                        self.writer.append_bytes(audio)
+            except (OSError, ValueError) as e:
+                logger.error("写入段 %d 失败: %s", self.next_index + 1, e)
+                audio = None
+
+            if audio is None:
+                self.failed_count += 1
+            else:
+                self.written_count += 1
+                self.timings.append(ChunkTiming(self.next_index, self.chunks[self.next_index], start,
+                                                self.writer.duration(), boundaries))
+                if self.on_written:
+                    self.file.flush()
+                    self.on_written(self.next_index, self.writer.position)
+            self.next_index += 1
+
+    def abort(self):
+        """停止转换：之后完成的段不再写入，文件只保留已连续写入的部分，下次可以续传"""
+        self.aborted = True
+        self.buffer.clear()
+
+    def close(self):
+        """写入最终的Xing/Info头并关闭文件"""
+        try:
+            with self.metrics.span("merge_finish"):
+                self.writer.finish()
+            self.metrics.count("bytes_written", self.writer.position - self.resumed_bytes)
+            self.metrics.count("audio_seconds", self.writer.duration() - self.resumed_seconds)
+        finally:
+            self.file.close()
+
+
+class ChunkDeferred(Exception):
+    """合成函数在发出请求前发现提交方已暂停：段放回该提交方队列的开头，继续后再发出"""
+
+
+class ChunkOwner:
+    """调度器中的一个提交方（一本书），有自己的队列、权重和暂停状态"""
+
+    def __init__(self, synthesize, weight=1):
+        self.synthesize = synthesize  # async (text) -> 音频数据，失败时为None
+        self.weight = max(weight, 1e-3)
+        self.items = deque()
+        self.pass_value = 0.0  # 步幅调度的虚拟时间，越小越先被调度
+        self.paused = False
+        self.running = set()  # 已发出、合成中的请求（task）
+        self.space = asyncio.Event()  # 队列有空位
+        self.space.set()
+
+
+class InflightChunk:
+    """正在排队或合成中的段，以及等待同一结果的其他请求"""
+
+    def __init__(self, text):
+        self.text = text
+        self.waiters = []  # (提交方, future)
+
+
+class ChunkScheduler:
+    """共享的文本段调度器：所有章节（以及多本书）的段用同一个并发上限请求TTS服务
+
+    每个提交方有独立的有界队列，按权重做步幅调度（stride scheduling），
+    长书不会饿死短书，也可以单独暂停或取消某个提交方。
+    提交时带上合成键的段会合并：同一个键在排队或合成中时，后来的请求等待同一个结果，不再重复请求。
+    """
+
+    def __init__(self, synthesize=None, max_concurrent=6):
+        self.max_concurrent = max_concurrent
+        self.queue_limit = max_concurrent * 2  # 每个提交方最多排队的段数，生产者在队列满时等待
+        self.owners = {}
+        self.inflight = {}  # 合成键 -> InflightChunk
+        self.workers = []
+        self.closing = False
+        self.loop = None
+        self._changed = asyncio.Event()
+        if synthesize:
+            self.register(None, synthesize)
+
+    def register(self, owner, synthesize, weight=1):
+        """登记一个提交方；新提交方从当前最小的虚拟时间开始，不会因为来得晚而插队"""
+        state = ChunkOwner(synthesize, weight)
+        active = [o.pass_value for o in self.owners.values() if o.items]
+        state.pass_value = min(active) if active else 0.0
+        self.owners[owner] = state
+        return state
+
+    def unregister(self, owner):
+        self._cancel(owner)
+        self.owners.pop(owner, None)
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.max_concurrent)]
+
+    def _call_in_loop(self, func, *args):
+        call_in_loop(self.loop, func, *args)
+
+    def _wake(self):
+        self._call_in_loop(self._changed.set)
+
+    def pause(self, owner=None):
+        """暂停一个提交方：不再发出它的新请求，已发出的请求正常完成"""
+        if owner in self.owners:
+            self.owners[owner].paused = True
+
+    def resume(self, owner=None):
+        if owner in self.owners:
+            self.owners[owner].paused = False
+            self._wake()
+
+    def cancel(self, owner=None):
+        """丢弃一个提交方尚未发出的段并取消已发出的请求，对应的结果为None"""
+        self._call_in_loop(self._cancel, owner)
+
+    def _cancel(self, owner):
+        state = self.owners.get(owner)
+        if state is None:
+            return
+        # 该提交方在等待其他提交方的段，直接放弃
+        for chunk in self.inflight.values():
+            for waiter in [w for w in chunk.waiters if w[0] is owner]:
+                chunk.waiters.remove(waiter)
+                if not waiter[1].done():
+                    waiter[1].set_result(None)
+        while state.items:
+            text, future, key = state.items.popleft()
+            if not future.done():
+                future.set_result(None)
+            if key is not None:
+                self._hand_over(key)
+        for task in state.running:
+            task.cancel()
+        state.space.set()
+
+    def _hand_over(self, key):
+        """被取消的段还有其他提交方在等待时，改由第一个等待方排队，否则移除"""
+        chunk = self.inflight[key]
+        while chunk.waiters:
+            owner, future = chunk.waiters.pop(0)
+            if owner in self.owners and not future.done():
+                self.owners[owner].items.append((chunk.text, future, key))
+                self._changed.set()
+                return
+        del self.inflight[key]
+
+    def _settle(self, key, audio):
+        """段合成结束：把结果交给所有等待同一个键的请求"""
+        chunk = self.inflight.pop(key, None)
+        if chunk is None:
+            return
+        for _, future in chunk.waiters:
+            if not future.done():
+                future.set_result(audio)
+
+    async def submit(self, text, owner=None, key=None):
+        """提交一个文本段，返回合成完成时得到音频数据的future
+
+        key为合成键（相同文本和语音参数的段键相同），为None时不合并
+        """
+        loop = asyncio.get_running_loop()
+        if key is not None and key in self.inflight:
+            future = loop.create_future()
+            self.inflight[key].waiters.append((owner, future))
+            return future
+
+        state = self.owners[owner]
+        while len(state.items) >= self.queue_limit:
+            state.space.clear()
+            await state.space.wait()
+        # 等待队列空位期间可能已有相同的段提交
+        if key is not None and key in self.inflight:
+            return await self.submit(text, owner, key)
+        future = loop.create_future()
+        state.items.append((text, future, key))
+        if key is not None:
+            self.inflight[key] = InflightChunk(text)
+        self._changed.set()
+        return future
+
+    def _take(self):
+        """取出虚拟时间最小、未暂停的提交方的下一个段"""
+        best = None
+        for state in self.owners.values():
+            if state.items and not state.paused:
+                if best is None or state.pass_value < best.pass_value:
+                    best = state
+        if best is None:
+            return None
+        best.pass_value += 1.0 / best.weight
+        text, future, key = best.items.popleft()
+        if len(best.items) < self.queue_limit:
+            best.space.set()
+        return best, text, future, key
+
+    async def worker(self):
+        while True:
+            self._changed.clear()
+            item = self._take()
+            if item is None:
+                if self.closing and not any(state.items for state in self.owners.values()):
+                    break
+                await self._changed.wait()
+                continue
+            # 可能还有其他段可取，让其他工作协程也继续
+            self._changed.set()
+
+            # 请求作为单独的task运行，取消提交方时可以中断，工作协程继续处理其他段
+            state, text, future, key = item
+            task = asyncio.ensure_future(state.synthesize(text))
+            state.running.add(task)
+            try:
+                await asyncio.wait([task])
+            finally:
+                state.running.discard(task)
+                if not task.done():
+                    task.cancel()
+            if not task.cancelled() and isinstance(task.exception(), ChunkDeferred):
+                # 工作协程取出段后提交方被暂停（如等待并发名额期间），不占用工作协程，等继续后重新调度
+                state.items.appendleft((text, future, key))
+                state.pass_value -= 1.0 / state.weight
+                self._changed.set()
+                continue
+            audio = None
+            if not task.cancelled():
+                if task.exception():
+                    logger.error("TTS段调度失败: %s", task.exception())
+                else:
+                    audio = task.result()
+            if not future.done():
+                future.set_result(audio)
+            if key is not None:
+                if task.cancelled() and key in self.inflight:
+                    self._hand_over(key)  # 其他提交方还在等待这个段
+                else:
+                    self._settle(key, audio)
+
+    async def close(self):
+        """等待队列中剩余的段完成后结束工作协程"""
+        self.closing = True
+        for state in self.owners.values():
+            state.paused = False
+        self._changed.set()
+        await asyncio.gather(*self.workers)
+        self.workers = []
@@ -0,0 +1,306 @@
+"""命令行批量转换入口，不依赖tkinter，可在无显示器的服务器上运行
+
+进度以JSON Lines格式输出到标准输出，日志输出到标准错误。
+--metrics指定目录时写入本次运行的统计汇总(JSON)和trace文件（可用ui.perfetto.dev打开）。
+退出码: 0 全部成功，1 有章节失败，2 参数错误，3 没有可转换的书籍或章节，130 被中断
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+from book_index import BookIndex
+from job_queue import JobQueue
+from subtitles import FORMATS as SUBTITLE_FORMATS
+from tts_backends import BACKENDS, create_backend
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NOTHING = 3
+EXIT_INTERRUPTED = 130
+
+RANGE_PATTERN = re.compile(r'^\s*(\d*\s*-\s*\d*|\d+)(\s*,\s*(\d*\s*-\s*\d*|\d+))*\s*$')
+
+
+def range_bounds(spec, total):
+    """逐个产出章节范围的(起始, 结束)编号（从1开始，含两端），范围无效时抛出ValueError"""
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, _, end = part.partition('-')
+            start = int(start) if start.strip() else 1
+            end = int(end) if end.strip() else total
+        else:
+            start = end = int(part)
+        if start < 1 or end < start:
+            raise ValueError(f"无效的章节范围: {part}")
+        yield start, end
+
+
+def parse_ranges(spec, total):
+    """解析章节范围，如"1-10,15,20-"，返回从0开始的索引列表"""
+    if not spec:
+        return list(range(total))
+    indexes = []
+    seen = set()
+    for start, end in range_bounds(spec, total):
+        for number in range(start, min(end, total) + 1):
+            if number not in seen:
+                seen.add(number)
+                indexes.append(number - 1)
+    return indexes
+
+
+def parse_subtitle_formats(spec):
+    """解析字幕格式列表，如 srt,lrc"""
+    formats = tuple(dict.fromkeys(part.strip().lower() for part in spec.split(',') if part.strip()))
+    unknown = [fmt for fmt in formats if fmt not in SUBTITLE_FORMATS]
+    if unknown or not formats:
+        raise argparse.ArgumentTypeError(f"无效的字幕格式: {spec}（可选 {','.join(SUBTITLE_FORMATS)}）")
+    return formats
+
+
+def find_epubs(paths):
+    """展开参数中的文件和目录（目录递归查找.epub），返回{EPUB路径: 在输出根目录下的子目录名}
+
+    目录中的书按相对于该目录的路径命名，不同子目录中同名的书不会共用输出目录；仍然重名时加上序号
+    """
+    books = {}
+    names = set()
+
+    def add(epub_path, name):
+        if epub_path in books:
+            return
+        unique, number = name, 2
+        while unique in names:
+            unique, number = f"{name}_{number}", number + 1
+        names.add(unique)
+        books[epub_path] = unique
+
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if name.lower().endswith('.epub'):
+                        epub_path = os.path.join(dirpath, name)
+                        add(epub_path, os.path.splitext(os.path.relpath(epub_path, path))[0])
+        else:
+            add(path, os.path.splitext(os.path.basename(path))[0])
+    return books
+
+
+def output_dir_for(epub_path, output_root, name=None):
+    """指定输出根目录时每本书一个子目录(name，默认为书名)；未指定时与GUI一致：在EPUB同目录下创建"书名_audio"文件夹"""
+    if output_root:
+        return os.path.join(output_root, name or os.path.splitext(os.path.basename(epub_path))[0])
+    return os.path.join(os.path.dirname(os.path.abspath(epub_path)),
+                        os.path.splitext(os.path.basename(epub_path))[0] + "_audio")
+
+
+def chapter_state(status):
+    if status.startswith("失败"):
+        return "failed"
+    if status == "部分完成":
+        return "partial"
+    if status == "已停止":
+        return "stopped"
+    if status.startswith("跳过"):
+        return "skipped"
+    if status.startswith("完成"):
+        return "done"
+    return "running"
+
+
+class JsonProgress:
+    """把进度事件逐行写成JSON"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def emit(self, event, **fields):
+        fields = {"event": event, "time": round(time.time(), 3), **fields}
+        self.stream.write(json.dumps(fields, ensure_ascii=False) + "\n")
+        self.stream.flush()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="EPUB转TTS命令行批量转换")
+    parser.add_argument("paths", nargs="*", help="EPUB文件或包含EPUB的目录")
+    parser.add_argument("-o", "--output", help="输出根目录，每本书一个子目录（目录中的书保留相对路径）；默认在EPUB同目录下创建\"书名_audio\"")
+    parser.add_argument("-c", "--chapters", help="章节范围（从1开始），如 1-10,15,20-")
+    parser.add_argument("--engine", choices=sorted(BACKENDS) + ["command"], default="edge",
+                        help="TTS后端：edge为在线服务，espeak和command为本地离线引擎")
+    parser.add_argument("--command", help="command后端的合成命令，如 \"piper -m zh.onnx -f {output}\"，占位符见tts_backends.py")
+    parser.add_argument("--voice", help="语音，默认使用后端的默认语音")
+    parser.add_argument("--list-voices", action="store_true", help="只输出后端可用的语音列表")
+    parser.add_argument("--rate", default="+0%", help="语速，如 +10%%")
+    parser.add_argument("--volume", default="+0%", help="音量，如 -5%%")
+    parser.add_argument("--pitch", default="+0Hz", help="音调，如 +2Hz")
+    parser.add_argument("-j", "--concurrency", default="auto", help="TTS请求并发数，auto为自动调整（本地引擎为CPU核数）")
+    parser.add_argument("--order", choices=["toc", "longest-first"], default="toc",
+                        help="章节的合成顺序，longest-first为长章节优先，章节长短差别大时总耗时更短")
+    parser.add_argument("--single-file", choices=["mp3", "m4b"],
+                        help="另外生成整本书的有声书文件（带章节标记），选中的章节全部完成后生成")
+    parser.add_argument("--subtitles", type=parse_subtitle_formats, metavar="FORMATS",
+                        help="在章节音频旁边生成字幕和对齐文件，逗号分隔：srt,lrc,json（时间来自合成时的词边界）")
+    parser.add_argument("--parallel-books", type=int, default=2, help="同时进行的书数，所有书共用同一个并发上限")
+    parser.add_argument("--cache-dir", help="合成缓存目录，默认在输出目录下")
+    parser.add_argument("--list", action="store_true", help="只输出章节列表，不转换")
+    parser.add_argument("--metrics", metavar="DIR", help="把统计汇总和trace文件写入该目录")
+    parser.add_argument("-q", "--quiet", action="store_true", help="不输出日志")
+    parser.add_argument("-v", "--verbose", action="store_true", help="输出调试日志")
+    return parser
+
+
+def list_book(epub_path, args, progress):
+    """输出一本书的章节列表，书籍无法读取时返回False"""
+    try:
+        with BookIndex(epub_path) as book:
+            chapters = book.chapters()
+            indexes = parse_ranges(args.chapters, len(chapters))
+    except Exception as e:
+        progress.emit("book_error", book=epub_path, error=f"读取EPUB失败: {e}")
+        return False
+    for index in indexes:
+        progress.emit("chapter_info", book=epub_path, index=index + 1,
+                      title=chapters[index]['title'], href=chapters[index]['href'])
+    return True
+
+
+def submit_book(queue, epub_path, name, args, progress, failures):
+    """把一本书加入任务队列，章节选择在书开始转换时进行"""
+    output_dir = output_dir_for(epub_path, args.output, name)
+
+    def select(chapters):
+        selected = [chapters[index] for index in parse_ranges(args.chapters, len(chapters))]
+        if not selected:
+            raise ValueError("没有可转换的章节")
+        progress.emit("book_start", book=epub_path, output=output_dir, chapters=len(selected))
+        return selected
+
+    def on_progress(job, completed, total, title, status, chapter_id):
+        state = chapter_state(status)
+        if state in ("failed", "partial"):
+            failures[epub_path] = failures.get(epub_path, 0) + 1
+        progress.emit("chapter", book=epub_path, completed=completed, total=total,
+                      index=chapter_id + 1, title=title, state=state, status=status)
+
+    queue.submit(epub_path, output_dir, select=select, progress_callback=on_progress,
+                 voice=args.voice, rate=args.rate, volume=args.volume, pitch=args.pitch,
+                 chapter_order=args.order, single_file=args.single_file, subtitle_formats=args.subtitles,
+                 cache_dir=args.cache_dir)
+
+
+async def run(args, progress, backend):
+    if args.list_voices:
+        try:
+            voices = await backend.voices()
+        except Exception as e:
+            progress.emit("error", error=f"获取语音列表失败: {e}")
+            return EXIT_FAILED
+        for voice in voices:
+            progress.emit("voice", **voice)
+        return EXIT_OK
+
+    books = find_epubs(args.paths)
+    if not books:
+        progress.emit("error", error="没有找到EPUB文件")
+        return EXIT_NOTHING
+
+    if args.list:
+        listed = [list_book(epub_path, args, progress) for epub_path in books]
+        progress.emit("done", books=len(books), failed_books=listed.count(False), failed_chapters=0)
+        return EXIT_OK if any(listed) else EXIT_NOTHING
+
+    started = time.monotonic()
+    failures = {}
+    failed_books = []
+
+    def on_job_finished(job):
+        if job.state == "failed":
+            failed_books.append(job.epub_path)
+            progress.emit("book_error", book=job.epub_path, error=job.error)
+        else:
+            progress.emit("book_done", book=job.epub_path, state=job.state,
+                          failed=failures.get(job.epub_path, 0),
+                          audiobook=job.converter.audiobook_path if job.converter else None,
+                          seconds=round(time.monotonic() - started, 3))
+
+    # 所有书共用一个限速的合成池
+    max_concurrent = None if args.concurrency == "auto" else int(args.concurrency)
+    queue = JobQueue(max_concurrent, max_active_books=args.parallel_books, on_job_finished=on_job_finished,
+                     backend=backend)
+    for epub_path, name in books.items():
+        submit_book(queue, epub_path, name, args, progress, failures)
+    await queue.run()
+
+    summary = queue.metrics.summary()
+    if args.metrics:
+        try:
+            summary_path, trace_path = queue.metrics.export(args.metrics)
+            progress.emit("metrics", summary=summary_path, trace=trace_path)
+        except OSError as e:
+            logging.getLogger(__name__).warning("写入统计失败: %s", e)
+
+    failed_chapters = sum(failures.values())
+    progress.emit("done", books=len(books), failed_books=len(failed_books), failed_chapters=failed_chapters,
+                  seconds=summary["elapsed_seconds"], chars_per_second=summary["chars_per_second"],
+                  audio_seconds=summary["audio_seconds"], realtime_factor=summary["realtime_factor"])
+    if len(failed_books) == len(books):
+        return EXIT_NOTHING
+    if failed_books or failed_chapters:
+        return EXIT_FAILED
+    return EXIT_OK
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.concurrency != "auto" and not (args.concurrency.isdigit() and int(args.concurrency) > 0):
+        print(f"无效的并发数: {args.concurrency}", file=sys.stderr)
+        return EXIT_USAGE
+    if args.parallel_books < 1:
+        print(f"无效的同时进行的书数: {args.parallel_books}", file=sys.stderr)
+        return EXIT_USAGE
+    if args.chapters:
+        try:
+            if not RANGE_PATTERN.match(args.chapters):
+                raise ValueError(f"无效的章节范围: {args.chapters}")
+            # 章节数在打开书籍后才知道，这里只检查范围本身（如3-1），不展开开放的范围
+            list(range_bounds(args.chapters, sys.maxsize))
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return EXIT_USAGE
+    if not args.paths and not args.list_voices:
+        print("请指定EPUB文件或目录", file=sys.stderr)
+        return EXIT_USAGE
+    try:
+        backend = create_backend(args.engine, command=args.command)
+    except (ValueError, RuntimeError) as e:
+        print(f"无法创建TTS后端: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    # 日志输出到标准错误，标准输出只保留JSON进度
+    logging.basicConfig(stream=sys.stderr, format="%(asctime)s %(levelname)s %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    if args.quiet:
+        logging.disable(logging.CRITICAL)
+    progress = JsonProgress(sys.stdout)
+    try:
+        return asyncio.run(run(args, progress, backend))
+    except KeyboardInterrupt:
+        progress.emit("interrupted")
+        return EXIT_INTERRUPTED
+    finally:
+        backend.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
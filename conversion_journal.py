@@ -0,0 +1,138 @@
+import os
+import sqlite3
+import time
+
+
+class ConversionJournal:
+    """转换任务日志，记录每个章节和文本段的状态，用于中断后续传
+
+    同一输出目录可以放多本书，章节记录属于book（书籍标识）对应的书；
+    查找、复用和清理只涉及本书的章节，不会移动或删除其他书的音频
+    """
+
+    def __init__(self, db_path, book):
+        self.db_path = db_path
+        self.book = book
+        self.conn = sqlite3.connect(db_path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chapters (
+                output_path TEXT PRIMARY KEY,
+                title TEXT,
+                href TEXT,
+                text_hash TEXT,
+                state TEXT,
+                updated_at REAL,
+                book TEXT
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                output_path TEXT,
+                idx INTEGER,
+                text_hash TEXT,
+                end_offset INTEGER,
+                state TEXT,
+                updated_at REAL,
+                PRIMARY KEY (output_path, idx)
+            );
+            CREATE INDEX IF NOT EXISTS chapters_text_hash ON chapters (text_hash);
+        """)
+
+    def chapter_done(self, output_path, text_hash):
+        """本书的章节是否已用相同文本完成转换且输出文件仍存在"""
+        row = self.conn.execute(
+            "SELECT text_hash, state FROM chapters WHERE output_path = ? AND book = ?", (output_path, self.book)
+        ).fetchone()
+        return row is not None and row[0] == text_hash and row[1] == "done" and os.path.exists(output_path)
+
+    def chapter(self, output_path):
+        """本书章节的(text_hash, state)，没有记录或属于其他书时返回None"""
+        return self.conn.execute(
+            "SELECT text_hash, state FROM chapters WHERE output_path = ? AND book = ?", (output_path, self.book)
+        ).fetchone()
+
+    def find_done(self, text_hash, exclude=None):
+        """本书中已用相同文本完成转换且文件仍存在的章节文件，没有时返回None"""
+        rows = self.conn.execute(
+            "SELECT output_path FROM chapters WHERE text_hash = ? AND state = 'done' AND book = ?",
+            (text_hash, self.book),
+        ).fetchall()
+        for (output_path,) in rows:
+            if output_path != exclude and os.path.exists(output_path):
+                return output_path
+        return None
+
+    def record_done(self, output_path, title, href, text_hash):
+        """登记直接复用已有音频的章节"""
+        self.conn.execute("DELETE FROM chunks WHERE output_path = ?", (output_path,))
+        self.conn.execute(
+            "INSERT OR REPLACE INTO chapters VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (output_path, title, href, text_hash, "done", time.time(), self.book),
+        )
+
+    def rename(self, old_path, new_path):
+        """章节文件改名后更新记录"""
+        self.forget(new_path)
+        self.conn.execute("UPDATE chapters SET output_path = ? WHERE output_path = ?", (new_path, old_path))
+        self.conn.execute("UPDATE chunks SET output_path = ? WHERE output_path = ?", (new_path, old_path))
+
+    def forget(self, output_path):
+        self.conn.execute("DELETE FROM chapters WHERE output_path = ?", (output_path,))
+        self.conn.execute("DELETE FROM chunks WHERE output_path = ?", (output_path,))
+
+    def paths_in(self, directory):
+        """目录下本书所有有记录的章节文件"""
+        prefix = os.path.join(directory, "")
+        rows = self.conn.execute("SELECT output_path FROM chapters WHERE book = ?", (self.book,)).fetchall()
+        return [output_path for (output_path,) in rows if output_path.startswith(prefix)]
+
+    def begin_chapter(self, output_path, title, href, text_hash):
+        """登记章节开始转换，文本变化或文件原属于其他书时丢弃旧的段记录"""
+        row = self.conn.execute(
+            "SELECT text_hash, book FROM chapters WHERE output_path = ?", (output_path,)
+        ).fetchone()
+        if row is not None and (row[0] != text_hash or row[1] != self.book):
+            self.conn.execute("DELETE FROM chunks WHERE output_path = ?", (output_path,))
+        self.conn.execute(
+            "INSERT OR REPLACE INTO chapters VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (output_path, title, href, text_hash, "running", time.time(), self.book),
+        )
+
+    def finish_chapter(self, output_path, state):
+        self.conn.execute(
+            "UPDATE chapters SET state = ?, updated_at = ? WHERE output_path = ?",
+            (state, time.time(), output_path),
+        )
+        if state == "done":
+            self.conn.execute("DELETE FROM chunks WHERE output_path = ?", (output_path,))
+
+    def resume_point(self, output_path, keys):
+        """章节文件中已按顺序写入的段数和对应的文件长度，返回(下一段索引, 文件偏移)"""
+        rows = self.conn.execute(
+            "SELECT idx, text_hash, end_offset FROM chunks "
+            "WHERE output_path = ? AND state = 'done' ORDER BY idx",
+            (output_path,),
+        ).fetchall()
+        next_index, offset = 0, 0
+        for index, text_hash, end_offset in rows:
+            if index != next_index or index >= len(keys) or text_hash != keys[index]:
+                break
+            next_index, offset = index + 1, end_offset
+
+        try:
+            file_size = os.path.getsize(output_path)
+        except OSError:
+            return 0, 0
+        if file_size < offset:
+            return 0, 0
+        return next_index, offset
+
+    def mark_chunk(self, output_path, index, text_hash, end_offset, state):
+        """记录段已写入章节文件，end_offset为写入后的文件长度"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?)",
+            (output_path, index, text_hash, end_offset, state, time.time()),
+        )
+
+    def close(self):
+        self.conn.close()
@@ -1,163 +1,275 @@
-import zipfile
-import xml.etree.ElementTree as ET
-from bs4 import BeautifulSoup
-import edge_tts
 import asyncio
+import logging
 import os
 import re
-from pydub import AudioSegment
-import queue
-import threading
+import shutil
+from tts_cache import TTSCache, synthesis_key
+from conversion_journal import ConversionJournal
+from chunk_scheduler import ChapterJob, ChunkDeferred, ChunkScheduler, call_in_loop
+from adaptive_limiter import AdaptiveLimiter, backoff_delay
+from mp3_concat import Mp3Writer
+from audiobook import write_audiobook
+from book_index import BookIndex
+from text_extractor import TextExtractor
+from text_chunker import find_boilerplate, split_text
+from tts_backends import Boundary, EdgeBackend
+from subtitles import FORMATS as SUBTITLE_FORMATS, subtitle_path, write_subtitles
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+def safe_filename(title):
+    """去掉标题中不能用于文件名的字符"""
+    safe_title = re.sub(r'[^\w\s.-]', '', title)
+    return re.sub(r'[-\s]+', '-', safe_title)
+
 
 class EpubToTTS:
-    def __init__(self, epub_path, output_dir):
+    def __init__(self, epub_path, output_dir, cache_dir=None, book=None, backend=None):
         self.epub_path = epub_path
+        self.book = book  # 可与GUI共用已打开的书籍索引
         self.output_dir = output_dir
-        self.voice = "zh-CN-XiaoxiaoNeural"
+        self.backend = backend or EdgeBackend()  # TTS后端，默认Edge在线服务
+        self.voice = self.backend.default_voice
+        self.rate = "+0%"
+        self.volume = "+0%"
+        self.pitch = "+0Hz"
+        self.output_format = self.backend.output_format
         self.is_paused = False
         self.is_stopped = False
-        self.chunk_size = 2000  # 每段文本字符数
+        self.chunk_size = self.backend.max_payload_bytes  # 每段文本的最大字节数，接近后端单次请求的上限
+        self.chapter_order = "toc"  # 章节的合成顺序: toc按目录顺序，longest-first长章节优先（缩短总耗时）
+        self.single_file = None  # 另外生成整本书的有声书文件: None、"mp3"或"m4b"
+        self.audiobook_path = None  # 本次转换生成的有声书文件
+        self.subtitle_formats = ()  # 在章节音频旁边生成的字幕和对齐文件: srt、lrc、json
         
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
-
-    def split_text(self, text, chunk_size=2000):
-        """将长文本分割成小段"""
-        if len(text) <= chunk_size:
-            return [text]
-        
-        chunks = []
-        sentences = re.split(r'[。！？\n]', text)
-        current_chunk = ""
-        
-        for sentence in sentences:
-            if len(current_chunk + sentence) <= chunk_size:
-                current_chunk += sentence + "。"
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = sentence + "。"
         
-        if current_chunk:
-            chunks.append(current_chunk.strip())
-        
-        return chunks
+        # 合成结果缓存，默认放在输出目录下，重复转换时可跳过未改变的段
+        self.cache = TTSCache(cache_dir or os.path.join(output_dir, ".tts_cache"))
+        self.journal = None  # 转换时打开，记录章节和段的完成状态
+        self.limiter = None  # 转换时创建，控制TTS请求并发数
+        self.scheduler = None  # 转换时使用的文本段调度器，可与其他书共用
+        self.priority = 1  # 与其他书共用调度器时的权重
+        self.metrics = Metrics(enabled=False)  # 转换时为本次运行的统计
+        self.loop = None  # 转换所在的事件循环，暂停和停止可从其他线程调用
+        self._resumed = None  # 未暂停时为set状态的asyncio.Event，转换开始时创建
+        self.active_jobs = set()  # 正在合成的章节，停止时中止写入
+
+    def split_text(self, text, chunk_size=None, boilerplate=None):
+        """将长文本分割成小段，每段不超过chunk_size字节；boilerplate中的重复段落在能减少请求时单独成段"""
+        return split_text(text, chunk_size or self.chunk_size, boilerplate)
+
+    def chunk_key(self, text):
+        """文本段在当前语音参数下的缓存键"""
+        return synthesis_key(text, self.voice, self.rate, self.volume, self.pitch, self.output_format)
+
+    def store_in_cache(self, key, audio, boundaries=None):
+        """写入缓存，失败不影响转换；合并的重复段只写入一次（已缓存的段缺少词边界时补上）"""
+        if key in self.cache and (boundaries is None or self.cache.get_boundaries(key) is not None):
+            return
+        try:
+            self.cache.put_bytes(key, audio, boundaries)
+        except Exception as e:
+            logger.warning("写入TTS缓存失败: %s", e)
+
+    def cached_boundaries(self, key):
+        """缓存段的词边界，没有保存时返回None"""
+        boundaries = self.cache.get_boundaries(key)
+        return None if boundaries is None else [Boundary(*boundary) for boundary in boundaries]
 
-    async def text_to_speech_chunk(self, text, output_file, max_retries=3):
-        """将单个文本段转换为语音，支持重试"""
+    async def request_audio(self, text):
+        """通过后端合成一段文本并记录延迟，不经过临时文件；返回Synthesis（音频和后端提供的词边界）
+
+        结果在返回前写入缓存，之后提交的相同段直接命中缓存
+        """
+        with self.metrics.span("tts_request", lane=True, chars=len(text)):
+            result = await asyncio.wait_for(
+                self.backend.synthesize_timed(text, self.voice, self.rate, self.volume, self.pitch),
+                timeout=self.backend.timeout)
+        self.metrics.count("tts_chars", len(text))
+        if result.audio:
+            self.store_in_cache(self.chunk_key(text), result.audio, result.boundaries)
+        return result
+
+    async def text_to_speech_chunk(self, text, max_retries=3):
+        """将单个文本段转换为语音，支持重试，返回Synthesis，失败时返回None
+
+        每次发出请求（包括重试）前检查暂停：已暂停时抛出ChunkDeferred，调度器把段放回队列，继续后再发出
+        """
         for attempt in range(max_retries):
             try:
-                communicate = edge_tts.Communicate(text, self.voice)
-                await asyncio.wait_for(communicate.save(output_file), timeout=60.0)
-                return True
+                if self.limiter:
+                    async with self.limiter.request(len(text), ready=lambda: not self.is_paused) as acquired:
+                        if not acquired:
+                            raise ChunkDeferred()
+                        return await self.request_audio(text)
+                else:
+                    if self.is_paused:
+                        raise ChunkDeferred()
+                    return await self.request_audio(text)
+            except ChunkDeferred:
+                raise
             except Exception as e:
-                print(f"TTS段转换失败 (尝试 {attempt+1}/{max_retries}): {str(e)}")
+                logger.warning("TTS段转换失败 (尝试 %d/%d): %s", attempt + 1, max_retries, e)
                 if attempt < max_retries - 1:
-                    await asyncio.sleep(2)  # 等待2秒后重试
+                    self.metrics.count("tts_retries")
+                    # 指数退避加随机抖动，避免失败的请求同时重试
+                    delay = self.limiter.backoff_delay(attempt) if self.limiter else backoff_delay(attempt)
+                    await asyncio.sleep(delay)
                 else:
-                    print(f"TTS段最终失败: {str(e)}")
-                    return False
+                    logger.error("TTS段最终失败: %s", e)
+                    self.metrics.count("tts_failures")
+                    return None
 
-    async def text_to_speech(self, text, output_file):
-        """生产者-消费者模式的TTS转换"""
-        print(f"TTS开始: 文本长度={len(text)}, 输出文件={output_file}")
-        
-        chunks = self.split_text(text, self.chunk_size)
-        print(f"文本分割为 {len(chunks)} 段")
-        
-        if len(chunks) == 1:
-            try:
-                communicate = edge_tts.Communicate(text, self.voice)
-                await asyncio.wait_for(communicate.save(output_file), timeout=120.0)
-                print(f"TTS保存完成: {output_file}")
-                return
-            except Exception as e:
-                print(f"TTS转换失败: {str(e)}")
-                raise
-        
-        # 生产者-消费者模式
-        task_queue = asyncio.Queue()
-        result_dict = {}
-        
-        # 生产者：将任务放入队列
-        for i, chunk in enumerate(chunks):
-            await task_queue.put((i, chunk))
+    async def text_to_speech(self, text, output_file, scheduler=None):
+        """将一段文本转换为语音文件；未传入调度器时使用临时的调度器"""
+        own_scheduler = scheduler is None
+        if own_scheduler:
+            scheduler = ChunkScheduler(max_concurrent=self.backend.recommended_concurrency)
+            scheduler.start()
+        self.bind_loop()
+        self.attach_scheduler(scheduler)
+        try:
+            job = await self.submit_chapter(text, output_file, scheduler)
+            return await self.assemble_chapter(job)
+        finally:
+            if own_scheduler:
+                await scheduler.close()
+                self.scheduler = None
+
+    def attach_scheduler(self, scheduler):
+        """在调度器中登记本书，暂停状态同步到调度器"""
+        self.scheduler = scheduler
+        if self not in scheduler.owners:
+            scheduler.register(self, self.text_to_speech_chunk, self.priority)
+        if self.is_paused:
+            scheduler.pause(self)
+
+    async def submit_chapter(self, text, output_file, scheduler, boilerplate=None):
+        """分割文本并把需要合成的段提交给调度器，结果按顺序直接写入章节文件
+
+        boilerplate为各章重复的段落（find_boilerplate的结果），单独成段后各章共用同一个合成结果
+        """
+        logger.debug("TTS开始: 文本长度=%d, 输出文件=%s", len(text), output_file)
         
-        # 添加结束标记
-        for _ in range(6):  # 6个消费者
-            await task_queue.put(None)
+        with self.metrics.span("chunking", chars=len(text)):
+            chunks = self.split_text(text, self.chunk_size, boilerplate)
+            keys = [self.chunk_key(chunk) for chunk in chunks]
+        self.metrics.count("chars", len(text))
+        self.metrics.count("chunks", len(chunks))
+        logger.debug("文本分割为 %d 段", len(chunks))
         
-        # 消费者：处理TTS转换
-        async def consumer():
-            while True:
-                item = await task_queue.get()
-                if item is None:
-                    break
-                
-                index, chunk = item
-                temp_file = f"{output_file}.temp_{index}.mp3"
-                print(f"转换段 {index+1}/{len(chunks)}")
-                
-                success = await self.text_to_speech_chunk(chunk, temp_file)
-                if success:
-                    result_dict[index] = temp_file
-                
-                task_queue.task_done()
+        # 日志中记录的已写入部分直接保留，从下一段继续；
+        # 生成字幕时需要每段的时间，从头重新拼接（已合成的段来自缓存）
+        start_index, start_offset = 0, 0
+        on_written = None
+        if self.journal:
+            if not self.subtitle_formats:
+                start_index, start_offset = self.journal.resume_point(output_file, keys)
+            on_written = lambda index, offset: self.journal.mark_chunk(output_file, index, keys[index], offset, "done")
+            if start_index:
+                logger.info("续传: 已写入 %d/%d 段", start_index, len(chunks))
+        job = ChapterJob(output_file, chunks, keys, start_index, start_offset, on_written, self.metrics)
+        if not start_index:
+            self.move_subtitles(None, output_file)  # 旧的字幕与重新合成的音频不一致
+        self.active_jobs.add(job)
         
-        # 启动多个消费者
-        consumers = [asyncio.create_task(consumer()) for _ in range(6)]
+        # 命中缓存的段直接使用缓存文件，其余提交给调度器
+        cached_count = 0
+        coalesced_count = 0  # 与正在合成的相同段合并，不重复请求
+        for i in range(job.next_index, len(chunks)):
+            if self.is_stopped:
+                break
+            cached_file = self.cache.get(keys[i])
+            boundaries = None
+            if cached_file and self.subtitle_formats:
+                boundaries = self.cached_boundaries(keys[i])
+                if boundaries is None and self.backend.word_boundaries:
+                    cached_file = None  # 缓存中没有词边界（旧的缓存），重新合成一次
+            if cached_file:
+                job.complete(i, cached_file, boundaries)
+                cached_count += 1
+                continue
+            if keys[i] in scheduler.inflight:
+                coalesced_count += 1
+            future = await scheduler.submit(chunks[i], self, keys[i])
+            future.add_done_callback(lambda f, index=i: self.on_chunk_done(job, index, f))
+            job.futures.append(future)
+        if self.is_stopped:
+            # 等待队列空位期间收到停止，刚提交的段也要丢弃
+            job.abort()
+            scheduler.cancel(self)
         
-        # 等待所有任务完成
-        await asyncio.gather(*consumers)
+        if cached_count:
+            self.metrics.count("cache_hits", cached_count)
+            logger.info("TTS缓存命中 %d/%d 段", cached_count, len(chunks))
+        if coalesced_count:
+            self.metrics.count("coalesced", coalesced_count)
+            logger.info("与正在合成的相同段合并 %d 段", coalesced_count)
+        return job
+
+    def on_chunk_done(self, job, index, future):
+        """段合成完成：交给章节的重排缓冲区"""
+        result = None if future.cancelled() else future.result()
+        if result is None:
+            job.complete(index, None)
+        else:
+            job.complete(index, result.audio, result.boundaries)
+
+    async def assemble_chapter(self, job):
+        """等待章节的所有段写入完成，返回是否全部成功"""
+        try:
+            await asyncio.gather(*job.futures)
+        finally:
+            self.active_jobs.discard(job)
+            job.close()
         
-        # 按顺序合并音频
-        temp_files = [(i, result_dict[i]) for i in sorted(result_dict.keys())]
-        success_count = len(temp_files)
-        failed_count = len(chunks) - success_count
+        if job.aborted:
+            # 停止时保留已连续写入的部分用于续传，什么都没写入的文件直接删除
+            if job.written_count == 0:
+                os.remove(job.output_file)
+            logger.info("章节已停止: %s, 已写入 %d/%d 段", job.output_file, job.written_count, len(job.chunks))
+            return False
         
-        if failed_count > 0:
-            print(f"有 {failed_count} 段转换失败，成功 {success_count} 段")
-            if success_count == 0:
+        if job.failed_count > 0:
+            logger.warning("有 %d 段转换失败，成功 %d 段", job.failed_count, job.written_count)
+            if job.written_count == 0:
+                os.remove(job.output_file)
                 raise Exception("所有段都转换失败")
         
-        # 合并音频文件
-        try:
-            await asyncio.sleep(1)
-            self.simple_merge_audio(temp_files, output_file)
-            print(f"音频合并完成: {output_file}")
-        except Exception as e:
-            print(f"音频合并失败: {str(e)}")
-            raise
-        finally:
-            # 清理临时文件
-            await asyncio.sleep(2)
-            for _, temp_file in temp_files:
-                try:
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                except Exception as e:
-                    print(f"清理临时文件失败: {temp_file}, {str(e)}")
+        logger.info("音频写入完成: %s", job.output_file)
+        if self.subtitle_formats:
+            try:
+                with self.metrics.span("subtitles"):
+                    write_subtitles(job.output_file, self.subtitle_formats, job.timings)
+            except OSError as e:
+                logger.warning("写入字幕失败: %s, %s", job.output_file, e)
+        return job.failed_count == 0
 
     def simple_merge_audio(self, temp_files, output_file):
-        """简单的音频合并方法，不依赖ffmpeg"""
+        """按帧拼接音频文件，不解码也不依赖ffmpeg"""
         try:
             # 按索引排序
             temp_files.sort(key=lambda x: x[0])
             
-            # 读取所有音频数据并合并
             with open(output_file, 'wb') as outfile:
+                writer = Mp3Writer(outfile)
                 for index, temp_file in temp_files:
                     if os.path.exists(temp_file):
-                        with open(temp_file, 'rb') as infile:
-                            outfile.write(infile.read())
+                        writer.append_file(temp_file)
+                writer.finish()
             
-            print(f"简单音频合并完成: {output_file}")
+            logger.info("简单音频合并完成: %s", output_file)
         except Exception as e:
-            print(f"简单音频合并失败: {str(e)}")
+            logger.error("简单音频合并失败: %s", e)
             raise
 
     def merge_audio_files(self, temp_files, output_file):
         """使用pydub合并音频文件（需要ffmpeg）"""
+        from pydub import AudioSegment  # pydub导入时会查找ffmpeg，只在使用时导入
         try:
             temp_files.sort(key=lambda x: x[0])
             
@@ -170,185 +282,353 @@ class EpubToTTS:
             
             combined.export(output_file, format="mp3")
         except Exception as e:
-            print(f"pydub合并失败: {str(e)}")
+            logger.error("pydub合并失败: %s", e)
             raise
 
+    def output_path_for(self, chapter):
+        """章节的音频文件路径，由目录中的标题得到"""
+        return os.path.join(self.output_dir, f"{safe_filename(chapter['title'])}.mp3")
+
+    def audiobook_path_for(self, fmt):
+        """整本书的有声书文件路径，由OPF中的书名（没有时用EPUB文件名）得到"""
+        title = self.get_book().title or os.path.splitext(os.path.basename(self.epub_path))[0]
+        return os.path.join(self.output_dir, f"{safe_filename(title)}.{fmt}")
+
+    def write_audiobook(self, parts):
+        """把[(章节标题, 音频文件)]写成一个带章节标记的有声书文件，返回文件路径"""
+        path = self.audiobook_path_for(self.single_file)
+        with self.metrics.span("audiobook", chapters=len(parts)):
+            write_audiobook(path, parts, self.single_file, title=self.get_book().title, author=self.get_book().author)
+        return path
+
+    def previous_dir(self):
+        """新版本中被替换的章节音频暂存在这里，之后的章节文本相同时可以直接取回"""
+        return os.path.join(self.output_dir, ".previous")
+
+    def stash_previous(self, output_file, text_hash):
+        """要写入的文件是文本不同的已完成章节（新版本中章节移动或修改）时，先移到暂存目录而不是覆盖"""
+        row = self.journal.chapter(output_file)
+        if row is None or row[1] != "done" or row[0] == text_hash or not os.path.exists(output_file):
+            return
+        os.makedirs(self.previous_dir(), exist_ok=True)
+        stashed = os.path.join(self.previous_dir(), f"{row[0]}.mp3")
+        os.replace(output_file, stashed)
+        self.move_subtitles(output_file, stashed)
+        self.journal.rename(output_file, stashed)
+
+    def reuse_audio(self, chapter, output_file, text_hash, live_paths):
+        """新版本中改名或移动的章节：已有文本相同的音频时移到新的文件名，不重新合成
+
+        来源仍是目录中某个章节的文件时复制，否则移动；返回是否已复用
+        """
+        try:
+            self.stash_previous(output_file, text_hash)
+            source = self.journal.find_done(text_hash, exclude=output_file)
+            if source is None:
+                return False
+            if source in live_paths:
+                shutil.copyfile(source, output_file)
+                self.move_subtitles(source, output_file, copy=True)
+            else:
+                os.replace(source, output_file)
+                self.move_subtitles(source, output_file)
+                self.journal.forget(source)
+        except OSError as e:
+            logger.warning("复用已有音频失败，重新合成: %s", e)
+            return False
+        self.journal.record_done(output_file, chapter['title'], chapter['href'], text_hash)
+        logger.info("复用已有音频: %s -> %s", source, output_file)
+        return True
+
+    def discard_obsolete(self, live_paths):
+        """整本书转换完成后删除本书清单中不再属于目录的章节音频（新版本中已删除或修改的章节，以及没有被取回的暂存音频）"""
+        for output_path in self.journal.paths_in(self.output_dir):
+            if output_path in live_paths:
+                continue
+            try:
+                os.remove(output_path)
+                logger.info("删除旧版本的章节音频: %s", output_path)
+            except OSError:
+                pass
+            self.move_subtitles(None, output_path)
+            self.journal.forget(output_path)
+        try:
+            os.rmdir(self.previous_dir())
+        except OSError:
+            pass
+
+    def move_subtitles(self, source, destination, copy=False):
+        """章节音频移动或复制时，字幕文件跟着移动或复制；source为None时删除destination旁边的字幕"""
+        for fmt in SUBTITLE_FORMATS:
+            target = subtitle_path(destination, fmt)
+            origin = subtitle_path(source, fmt) if source else None
+            try:
+                if origin and os.path.exists(origin):
+                    if copy:
+                        shutil.copyfile(origin, target)
+                    else:
+                        os.replace(origin, target)
+                elif os.path.exists(target):
+                    os.remove(target)
+            except OSError as e:
+                logger.warning("处理字幕文件失败: %s, %s", target, e)
+
+    def has_subtitles(self, output_file):
+        """要求的字幕文件是否都已存在（不要求字幕时总是True）"""
+        return all(os.path.exists(subtitle_path(output_file, fmt)) for fmt in self.subtitle_formats)
+
+    def get_book(self):
+        """书籍索引，首次使用时打开EPUB"""
+        if self.book is None:
+            self.book = BookIndex(self.epub_path)
+        return self.book
+
+    def book_id(self):
+        """本书在转换日志中的标识：OPF的唯一标识（同一本书的新版本通常不变），没有时依次用书名和EPUB文件的路径"""
+        book = self.get_book()
+        return book.identifier or book.title or os.path.abspath(self.epub_path)
+
     def get_toc_structure(self):
         """获取目录结构"""
-        with zipfile.ZipFile(self.epub_path, 'r') as zip_ref:
-            print("=== EPUB文件列表 ===")
-            for file in zip_ref.namelist():
-                print(f"文件: {file}")
-            
-            ncx_path = None
-            for file in zip_ref.namelist():
-                if file.endswith('toc.ncx'):
-                    ncx_path = file
-                    break
-            
-            print(f"找到目录文件: {ncx_path}")
-            
-            if not ncx_path:
-                return []
-            
-            with zip_ref.open(ncx_path) as file:
-                content = file.read()
-                tree = ET.ElementTree(ET.fromstring(content))
-                root = tree.getroot()
-                
-                ns = {'': 'http://www.daisy.org/z3986/2005/ncx/'}
-                nav_points = root.findall('.//navPoint', ns)
-                
-                print(f"=== 目录结构 ===")
-                chapters = []
-                for i, nav_point in enumerate(nav_points, 1):
-                    title_elem = nav_point.find('navLabel/text', ns)
-                    content_elem = nav_point.find('content', ns)
-                    
-                    if title_elem is not None and content_elem is not None:
-                        title = f"{i}.{title_elem.text}"
-                        href = content_elem.get('src')
-                        chapters.append({'title': title, 'href': href})
-                        print(f"章节 {i}: 标题='{title}', 链接='{href}'")
-                
-                return chapters
+        chapters = self.get_book().chapters()
+        logger.info("=== 目录结构: %d 个章节 ===", len(chapters))
+        return chapters
 
     def extract_chapter_text_by_position(self, chapter_href, next_chapter_href=None):
-        """根据位置提取章节文本"""
-        print(f"按位置提取章节: {chapter_href}")
+        """根据位置提取章节文本，未指定下一章节时以目录中同一文件的下一个锚点为结束位置"""
+        logger.debug("按位置提取章节: %s", chapter_href)
         
         try:
-            with zipfile.ZipFile(self.epub_path, 'r') as zip_ref:
-                chapter_path = chapter_href.split('#')[0]
-                print(f"章节文件路径: {chapter_path}")
-                
-                with zip_ref.open(chapter_path) as file:
-                    content = file.read().decode('utf-8')
-                    print(f"文件内容长度: {len(content)} 字符")
-                
-                # 如果有下一章节，尝试在同一文件中分割
-                if next_chapter_href and next_chapter_href.startswith(chapter_path):
-                    current_pos = chapter_href.split('#filepos')[1] if '#filepos' in chapter_href else '0'
-                    next_pos = next_chapter_href.split('#filepos')[1] if '#filepos' in next_chapter_href else str(len(content))
-                    
-                    print(f"当前位置: {current_pos}, 下一位置: {next_pos}")
-                    
-                    try:
-                        start_pos = int(current_pos)
-                        end_pos = int(next_pos)
-                        
-                        print(f"提取范围: {start_pos} - {end_pos}")
-                        # 提取指定范围的内容
-                        chapter_content = content[start_pos:end_pos]
-                        print(f"章节内容长度: {len(chapter_content)} 字符")
-                        soup = BeautifulSoup(chapter_content, 'html.parser')
-                    except Exception as e:
-                        print(f"位置解析失败: {e}, 使用整个文件")
-                        soup = BeautifulSoup(content, 'html.parser')
-                else:
-                    print("使用整个文件内容")
-                    soup = BeautifulSoup(content, 'html.parser')
-                
-                # 移除脚本和样式
-                for script in soup(["script", "style"]):
-                    script.decompose()
-                
-                text = soup.get_text()
-                text = re.sub(r'\s+', ' ', text).strip()
-                
-                print(f"最终提取文本长度: {len(text)} 字符")
-                if len(text) > 0:
+            text = self.get_book().chapter_text(chapter_href, next_chapter_href)
+            
+            logger.debug("最终提取文本长度: %d 字符", len(text))
+            if len(text) > 0:
+                if logger.isEnabledFor(logging.DEBUG):
                     preview = text[:200] + "..." if len(text) > 200 else text
-                    print(f"文本预览: {preview}")
-                else:
-                    print("警告: 提取的文本为空!")
-                
-                return text
+                    logger.debug("文本预览: %s", preview)
+            else:
+                logger.warning("警告: 提取的文本为空!")
+            
+            return text
                 
         except Exception as e:
-            print(f"提取章节文本时发生异常: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("提取章节文本时发生异常: %s", e)
             return ""
 
-    async def convert_selected_chapters(self, selected_chapters, progress_callback, max_concurrent=3):
-        print(f"=== 开始转换章节 ===")
-        print(f"总章节数: {len(selected_chapters)}")
+    async def convert_selected_chapters(self, selected_chapters, progress_callback, max_concurrent=None, scheduler=None,
+                                        metrics=None):
+        """转换选中章节，所有章节的文本段共用一个调度器
+        
+        max_concurrent为同时进行的TTS请求数，为None时根据延迟和错误率自动调整；
+        传入scheduler时与其他书共用该调度器和self.limiter，max_concurrent不再使用；
+        未传入metrics时本次运行的统计写入输出目录的.metrics文件夹；
+        chapter_order为longest-first时按估算的长度从长到短提交章节，进度回调仍使用目录中的标题和序号；
+        输出目录中的转换日志同时是本书的清单（每章的文本哈希和音频文件，按书籍标识区分同一目录中的不同书）：
+        再次转换新版本时只合成新增或修改的章节，改名或移动的章节直接使用原有的音频文件；
+        single_file为mp3或m4b时，选中的章节全部完成后再按目录顺序写成一个带章节标记的有声书文件
+        """
+        logger.info("=== 开始转换章节 ===")
+        logger.info("总章节数: %d", len(selected_chapters))
         
         total_chapters = len(selected_chapters)
         completed = 0
-        semaphore = asyncio.Semaphore(max_concurrent)
+        audio_files = {}  # 章节序号 -> 已完成的音频文件，用于生成有声书
+        incomplete = 0  # 部分完成或失败的章节数
+        self.audiobook_path = None
+        self.journal = ConversionJournal(os.path.join(self.output_dir, ".conversion_journal.db"), self.book_id())
+        self.bind_loop()
+        own_metrics = metrics is None
+        self.metrics = Metrics() if own_metrics else metrics
+        self.get_book().metrics = self.metrics
+        own_scheduler = scheduler is None
+        if own_scheduler:
+            if max_concurrent is None and not self.backend.adaptive:
+                max_concurrent = self.backend.recommended_concurrency  # 本地引擎按CPU核数固定并发
+            if max_concurrent is None:
+                self.limiter = AdaptiveLimiter(max_limit=self.backend.max_concurrency)
+            else:
+                self.limiter = AdaptiveLimiter.fixed(max_concurrent)
+            scheduler = ChunkScheduler(max_concurrent=self.limiter.max_limit)
+            scheduler.start()
+        self.attach_scheduler(scheduler)
+        extractor = TextExtractor(self.get_book())
+        extractor.start()
         
-        async def convert_single_chapter(chapter, index):
-            nonlocal completed
-            print(f"开始处理章节 {index+1}: {chapter['title']}")
-            
-            async with semaphore:
-                if self.is_stopped:
-                    print(f"章节 {index+1} 被停止")
+        def report(chapter, status):
+            """进度回调：(已完成数, 总数, 标题, 状态, 章节id)，章节id为目录中的序号，标题重复时也能区分"""
+            progress_callback(completed, total_chapters, chapter['title'], status, chapter.get('id'))
+        
+        async def finish_chapter(chapter, index, job):
+            """章节最后一段完成后立即合并"""
+            nonlocal completed, incomplete
+            try:
+                with self.metrics.span("chapter", lane=True, title=chapter['title']):
+                    all_done = await self.assemble_chapter(job)
+                if job.aborted:
+                    self.journal.finish_chapter(job.output_file, "stopped")
+                    report(chapter, "已停止")
                     return
-                
-                while self.is_paused and not self.is_stopped:
-                    await asyncio.sleep(0.1)
-                
+                self.journal.finish_chapter(job.output_file, "done" if all_done else "partial")
+                completed += 1
+                if all_done:
+                    audio_files[index] = job.output_file
+                else:
+                    incomplete += 1
+                logger.info("章节 %d 转换完成", index + 1)
+                report(chapter, "完成" if all_done else "部分完成")
+            except Exception as e:
+                self.journal.finish_chapter(job.output_file, "failed")
+                completed += 1
+                incomplete += 1
+                logger.error("章节 %d 转换失败: %s", index + 1, e)
+                report(chapter, f"失败: {str(e)}")
+        
+        # 目录中所有章节的文件名，复用音频时这些文件只复制不移动
+        live_paths = {self.output_path_for(chapter) for chapter in self.get_book().chapters()}
+        live_paths.update(self.output_path_for(chapter) for chapter in selected_chapters)
+        
+        # 长章节优先（LPT）：最长的章节最先开始，避免它在最后单独拖长总耗时
+        order = list(range(total_chapters))
+        if self.chapter_order == "longest-first":
+            sizes = [self.get_book().estimated_size(chapter['href']) for chapter in selected_chapters]
+            order.sort(key=lambda i: -sizes[i])
+        
+        chapter_tasks = []
+        try:
+            # 文本提取在进程池中进行；先取得所有选中章节的文本，找出在多章中重复的段落（页眉、页脚、译者注等），
+            # 这些段落单独成段，整个选择中只合成一次
+            ordered_chapters = [selected_chapters[i] for i in order]
+            extracted = []
+            async for position, chapter, text in extractor.chapter_texts(ordered_chapters):
                 if self.is_stopped:
-                    print(f"章节 {index+1} 被停止")
-                    return
-                
-                progress_callback(completed, total_chapters, chapter['title'], "处理中...")
-                
-                print(f"提取章节文本: {chapter['title']}")
-                # 获取下一章节信息用于更好的文本分割
-                next_chapter = selected_chapters[index + 1] if index + 1 < len(selected_chapters) else None
-                next_href = next_chapter['href'] if next_chapter else None
+                    break
+                extracted.append((order[position], chapter, text))
+            with self.metrics.span("boilerplate"):
+                boilerplate = find_boilerplate([text for _, _, text in extracted])
+            if boilerplate:
+                logger.info("各章重复的段落: %d 种", len(boilerplate))
+            
+            for index, chapter, text in extracted:
+                await self.wait_while_paused()
+                if self.is_stopped:
+                    logger.info("章节 %d 被停止", index + 1)
+                    break
                 
-                # 使用改进的文本提取方法
-                text = self.extract_chapter_text_by_position(chapter['href'], next_href)
-                print(f"文本提取完成，长度: {len(text)}")
+                logger.info("开始处理章节 %d: %s", index + 1, chapter['title'])
+                report(chapter, "处理中...")
+                logger.debug("文本提取完成，长度: %d", len(text))
                 
                 if not text:
                     completed += 1
-                    print(f"章节 {index+1} 内容为空，跳过")
-                    progress_callback(completed, total_chapters, chapter['title'], "跳过(空)")
-                    return
+                    logger.info("章节 %d 内容为空，跳过", index + 1)
+                    report(chapter, "跳过(空)")
+                    continue
                 
-                safe_title = re.sub(r'[^\w\s.-]', '', chapter['title'])
-                safe_title = re.sub(r'[-\s]+', '-', safe_title)
-                output_file = os.path.join(self.output_dir, f"{safe_title}.mp3")
-                print(f"输出文件: {output_file}")
+                output_file = self.output_path_for(chapter)
+                logger.debug("输出文件: %s", output_file)
                 
-                try:
-                    print(f"开始TTS转换: {chapter['title']}")
-                    await self.text_to_speech(text, output_file)
+                text_hash = self.chunk_key(text)
+                if self.journal.chapter_done(output_file, text_hash) and self.has_subtitles(output_file):
                     completed += 1
-                    print(f"章节 {index+1} 转换完成")
-                    progress_callback(completed, total_chapters, chapter['title'], "完成")
-                except Exception as e:
+                    audio_files[index] = output_file
+                    logger.info("章节 %d 已转换，跳过", index + 1)
+                    report(chapter, "完成(已存在)")
+                    continue
+                if self.reuse_audio(chapter, output_file, text_hash, live_paths) and self.has_subtitles(output_file):
                     completed += 1
-                    print(f"章节 {index+1} 转换失败: {str(e)}")
-                    progress_callback(completed, total_chapters, chapter['title'], f"失败: {str(e)}")
-        
-        print("创建并发任务...")
-        tasks = [convert_single_chapter(chapter, i) for i, chapter in enumerate(selected_chapters)]
-        print(f"任务数量: {len(tasks)}")
-        
-        await asyncio.gather(*tasks, return_exceptions=True)
-        print("=== 所有章节处理完成 ===")
+                    audio_files[index] = output_file
+                    logger.info("章节 %d 已有相同文本的音频，跳过", index + 1)
+                    report(chapter, "完成(已移动)")
+                    continue
+                self.journal.begin_chapter(output_file, chapter['title'], chapter['href'], text_hash)
+                
+                logger.debug("开始TTS转换: %s", chapter['title'])
+                job = await self.submit_chapter(text, output_file, scheduler, boilerplate)
+                chapter_tasks.append(asyncio.create_task(finish_chapter(chapter, index, job)))
+            
+            await asyncio.gather(*chapter_tasks, return_exceptions=True)
+            if not self.is_stopped and len(selected_chapters) == len(self.get_book().chapters()):
+                self.discard_obsolete(live_paths)
+            if self.single_file and not self.is_stopped:
+                if incomplete:
+                    logger.warning("有 %d 个章节没有完成，不生成有声书文件", incomplete)
+                elif audio_files:
+                    # 拼接的文件可能有几百MB，在线程池中写入，不阻塞共用事件循环的其他书
+                    parts = [(selected_chapters[index]['title'], audio_files[index]) for index in sorted(audio_files)]
+                    self.audiobook_path = await asyncio.get_running_loop().run_in_executor(
+                        None, self.write_audiobook, parts)
+        finally:
+            extractor.close()
+            if own_scheduler:
+                await scheduler.close()
+            else:
+                scheduler.unregister(self)
+            self.scheduler = None
+            self.journal.close()
+            self.journal = None
+            if own_metrics:
+                self.export_metrics()
+        logger.info("=== 所有章节处理完成 ===")
+
+    def export_metrics(self):
+        """把本次运行的统计写入输出目录，失败不影响转换"""
+        summary = self.metrics.summary()
+        logger.info("用时 %.1f 秒, %.0f 字/秒, 生成音频 %.1f 秒 (%.1f 倍实时)",
+                    summary["elapsed_seconds"], summary["chars_per_second"],
+                    summary["audio_seconds"], summary["realtime_factor"])
+        try:
+            summary_path, trace_path = self.metrics.export(os.path.join(self.output_dir, ".metrics"))
+            logger.info("统计已写入: %s, %s", summary_path, trace_path)
+        except OSError as e:
+            logger.warning("写入统计失败: %s", e)
     
     async def convert_with_callback(self, progress_callback):
         """转换整个EPUB为音频文件，带进度回调"""
         chapters = self.get_toc_structure()
         await self.convert_selected_chapters(chapters, progress_callback)
     
+    def bind_loop(self):
+        """转换开始时记录事件循环并创建暂停用的事件"""
+        self.loop = asyncio.get_running_loop()
+        self._resumed = asyncio.Event()
+        self._update_resumed()
+
+    def _update_resumed(self):
+        if self.is_paused and not self.is_stopped:
+            self._resumed.clear()
+        else:
+            self._resumed.set()
+
+    async def wait_while_paused(self):
+        if self._resumed is not None:
+            await self._resumed.wait()
+
     def pause(self):
+        """暂停：调度器立即停止发出本书的新请求，已发出的请求正常完成"""
         self.is_paused = True
+        if self.scheduler:
+            self.scheduler.pause(self)
+        call_in_loop(self.loop, self._update_resumed)
     
     def resume(self):
         self.is_paused = False
+        if self.scheduler:
+            self.scheduler.resume(self)
+        call_in_loop(self.loop, self._update_resumed)
     
     def stop(self):
+        """停止：丢弃未发出的段，取消合成中的请求，章节文件只保留已连续写入的部分"""
         self.is_stopped = True
         self.is_paused = False
+        call_in_loop(self.loop, self._stop_in_loop)
+
+    def _stop_in_loop(self):
+        self._update_resumed()
+        for job in list(self.active_jobs):
+            job.abort()
+        if self.scheduler:
+            self.scheduler.resume(self)
+            self.scheduler.cancel(self)
 
 
 
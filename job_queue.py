@@ -0,0 +1,179 @@
+import asyncio
+import itertools
+import logging
+
+from adaptive_limiter import AdaptiveLimiter
+from chunk_scheduler import ChunkScheduler
+from epub_converter import EpubToTTS
+from metrics import Metrics
+from tts_backends import EdgeBackend
+
+logger = logging.getLogger(__name__)
+
+
+class BookJob:
+    """队列中的一本书"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, epub_path, output_dir, select=None, priority=1, progress_callback=None, settings=None):
+        self.id = next(self._ids)
+        self.epub_path = epub_path
+        self.output_dir = output_dir
+        self.select = select  # (全部章节) -> 要转换的章节，为None时转换全部
+        self.priority = priority
+        self.progress_callback = progress_callback
+        self.settings = settings or {}  # voice/rate/volume/pitch/chapter_order/single_file/subtitle_formats/cache_dir
+        self.state = "queued"  # queued/running/paused/done/failed/cancelled
+        self.error = None
+        self.converter = None
+        self.task = None
+
+    def on_progress(self, completed, total, title, status, chapter_id=None):
+        if self.progress_callback:
+            self.progress_callback(self, completed, total, title, status, chapter_id)
+
+
+class JobQueue:
+    """多书任务队列：所有书籍的文本段共用一个限速的合成池，按优先级公平分配请求
+
+    submit/pause/resume/cancel需在运行队列的事件循环线程中调用
+    """
+
+    def __init__(self, max_concurrent=None, max_active_books=4, on_job_finished=None, backend=None,
+                 keep_alive=False, shared_metrics=True):
+        if max_active_books < 1:
+            raise ValueError(f"同时进行的书数至少为1: {max_active_books}")
+        self.backend = backend or EdgeBackend()  # 所有书共用的TTS后端
+        self.limiter = None
+        self.set_concurrency(max_concurrent)
+        self.max_active_books = max_active_books  # 同时提取文本和组装章节的书数
+        self.on_job_finished = on_job_finished  # (job)，每本书结束（完成、失败或取消）时调用
+        self.keep_alive = keep_alive  # 为True时队列空了也继续等待新的书，直到调用close
+        # 常驻的队列之后可能改用更高的并发数，工作协程按后端的上限创建
+        workers = max(self.limiter.max_limit, self.backend.max_concurrency) if keep_alive else self.limiter.max_limit
+        self.scheduler = ChunkScheduler(max_concurrent=workers)
+        self.metrics = Metrics() if shared_metrics else None  # 所有书共用的统计，为None时每本书单独统计并写入输出目录
+        self.closing = False
+        self.jobs = []
+        self._wakeup = asyncio.Event()
+
+    def set_concurrency(self, max_concurrent=None):
+        """设置之后开始的书使用的并发数，None为根据延迟和错误率自动调整；设置不变时保留已调整好的限速器"""
+        if max_concurrent is None and not self.backend.adaptive:
+            max_concurrent = self.backend.recommended_concurrency
+        if self.limiter is not None and self.limiter.adaptive == (max_concurrent is None):
+            if max_concurrent is None or self.limiter.limit == max_concurrent:
+                return
+        if max_concurrent is None:
+            self.limiter = AdaptiveLimiter(max_limit=self.backend.max_concurrency)
+        else:
+            self.limiter = AdaptiveLimiter.fixed(max_concurrent)
+
+    def close(self):
+        """keep_alive模式下让run在当前的书结束后返回"""
+        self.closing = True
+        self._wakeup.set()
+
+    def submit(self, epub_path, output_dir, select=None, priority=1, progress_callback=None, **settings):
+        """加入一本书，返回BookJob；运行中也可以继续加入"""
+        job = BookJob(epub_path, output_dir, select, priority, progress_callback, settings)
+        self.jobs.append(job)
+        self._wakeup.set()
+        return job
+
+    def pause(self, job):
+        """暂停一本书，其他书继续使用全部并发"""
+        if job.state not in ("running", "queued"):
+            return
+        if job.converter:
+            job.converter.pause()
+        job.state = "paused"
+
+    def resume(self, job):
+        if job.state != "paused":
+            return
+        if job.task:
+            if job.converter:
+                job.converter.resume()
+            job.state = "running"
+        else:
+            job.state = "queued"
+            self._wakeup.set()
+
+    def cancel(self, job):
+        """取消一本书：未开始的直接移出队列，进行中的丢弃未发出的请求"""
+        if job.state in ("done", "failed", "cancelled"):
+            return
+        if job.converter:
+            job.converter.stop()
+        job.state = "cancelled"
+        self._wakeup.set()
+        if job.task is None:
+            if self.keep_alive:
+                self.jobs.remove(job)
+            if self.on_job_finished:
+                self.on_job_finished(job)
+
+    def _next_job(self):
+        """优先级高的先开始，同优先级按加入顺序"""
+        queued = [job for job in self.jobs if job.state == "queued"]
+        if not queued:
+            return None
+        return max(queued, key=lambda job: (job.priority, -job.id))
+
+    async def _run_job(self, job):
+        try:
+            converter = EpubToTTS(job.epub_path, job.output_dir, cache_dir=job.settings.get('cache_dir'),
+                                  book=job.settings.get('book'), backend=self.backend)
+            for name in ('voice', 'rate', 'volume', 'pitch', 'chapter_order', 'single_file', 'subtitle_formats'):
+                if job.settings.get(name):
+                    setattr(converter, name, job.settings[name])
+            converter.priority = job.priority
+            converter.limiter = self.limiter
+            job.converter = converter
+            if job.state == "cancelled":
+                return
+            if job.state == "paused":
+                converter.pause()
+
+            chapters = converter.get_toc_structure()
+            selected = job.select(chapters) if job.select else chapters
+            await converter.convert_selected_chapters(selected, job.on_progress, scheduler=self.scheduler,
+                                                      metrics=self.metrics)
+            if job.state != "cancelled":
+                job.state = "done"
+        except Exception as e:
+            logger.error("书籍转换失败: %s, %s", job.epub_path, e)
+            job.state = "failed"
+            job.error = str(e)
+        finally:
+            # 调用方传入的书籍索引由调用方关闭
+            if job.converter and job.converter.book and job.converter.book is not job.settings.get('book'):
+                job.converter.book.close()
+            if self.keep_alive:
+                self.jobs.remove(job)
+            self._wakeup.set()
+            if self.on_job_finished:
+                self.on_job_finished(job)
+
+    async def run(self):
+        """运行直到队列中的书全部结束（已暂停且未开始的书不会阻止退出）；keep_alive模式下运行到调用close为止"""
+        self.scheduler.start()
+        try:
+            while True:
+                self._wakeup.clear()
+                running = [job for job in self.jobs if job.task and not job.task.done()]
+                while len(running) < self.max_active_books:
+                    job = self._next_job()
+                    if job is None:
+                        break
+                    job.state = "running"
+                    job.task = asyncio.create_task(self._run_job(job))
+                    running.append(job)
+
+                if not running and (not self.keep_alive or self.closing):
+                    break
+                await self._wakeup.wait()
+        finally:
+            await self.scheduler.close()
@@ -1,11 +1,17 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import os
-import asyncio
+import logging
 import threading
-from epub_converter import EpubToTTS
+from book_index import BookIndex
+from chapter_list import ChapterList
+from tts_engine import TTSEngine
 import re
 
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 100  # 进度刷新间隔（毫秒），期间的进度事件合并为一次界面更新
+
 try:
     from tkinterdnd2 import DND_FILES, TkinterDnD
     DND_AVAILABLE = True
@@ -20,13 +26,48 @@ class EpubTTSGUI:
         
         self.epub_path = ""
         self.output_path = ""
-        self.converter = None
-        self.is_running = False
-        self.is_paused = False
+        self.job = None  # 当前的转换任务，运行状态以引擎中的job.state为准
+        self.book = None  # 当前EPUB的书籍索引，目录、转换和保存文本共用
         self.chapters = []
         
+        # 引擎线程写入、界面线程定时取出的进度：每个章节只保留最新的状态
+        self._progress_lock = threading.Lock()
+        self._pending_status = {}  # (任务id, 章节id) -> (任务, 章节id, 状态)
+        self._pending_totals = None  # (任务, 已完成数, 总数, 统计快照)
+        self._progress_scheduled = False
+        
+        # 常驻的转换引擎：多次转换共用同一个事件循环、TTS后端和限速器
+        self.engine = TTSEngine()
+        self.engine.start()
+        self.engine.subscribe(self.on_engine_event)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        
         self.setup_ui()
     
+    @property
+    def is_running(self):
+        return self.job is not None and self.job.state in ("queued", "running", "paused")
+    
+    @property
+    def is_paused(self):
+        return self.job is not None and self.job.state == "paused"
+    
+    def on_close(self):
+        self.engine.close()
+        if self.job and self.job.settings.get("book") not in (None, self.book):
+            self.job.settings["book"].close()
+        if self.book:
+            self.book.close()
+        self.root.destroy()
+
+    def release_book(self, book):
+        """界面不再使用的书籍索引：转换任务仍在使用时不关闭，等任务结束后再关闭"""
+        if book is None:
+            return
+        if self.is_running and self.job.settings.get("book") is book:
+            return
+        book.close()
+    
     def setup_ui(self):
         # 文件选择区域
         file_frame = ttk.Frame(self.root, padding="10")
@@ -74,12 +115,27 @@ class EpubTTSGUI:
         concurrent_frame = ttk.Frame(options_frame)
         concurrent_frame.pack(side=tk.RIGHT)
         
+        # 全书共用的TTS请求并发数，"自动"时根据延迟和错误率自动调整
         ttk.Label(concurrent_frame, text="并发线程数:").pack(side=tk.LEFT, padx=(20,5))
-        self.concurrent_var = tk.StringVar(value="3")
+        self.concurrent_var = tk.StringVar(value="自动")
         concurrent_combo = ttk.Combobox(concurrent_frame, textvariable=self.concurrent_var, 
-                                       values=["1", "2", "3", "4", "5", "6"], width=5, state="readonly")
+                                       values=["自动"] + [str(i) for i in range(1, 13)], width=5, state="readonly")
         concurrent_combo.pack(side=tk.LEFT)
         
+        # 长章节优先：章节长短差别大时缩短总耗时，进度仍按目录显示
+        self.longest_first_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(concurrent_frame, text="长章节优先", variable=self.longest_first_var).pack(side=tk.LEFT, padx=(10,0))
+        
+        # 整本有声书：章节全部完成后另外生成一个带章节标记的文件
+        ttk.Label(concurrent_frame, text="整本输出:").pack(side=tk.LEFT, padx=(10,5))
+        self.single_file_var = tk.StringVar(value="无")
+        ttk.Combobox(concurrent_frame, textvariable=self.single_file_var, values=["无", "MP3", "M4B"],
+                     width=5, state="readonly").pack(side=tk.LEFT)
+        
+        # 字幕：每章旁边生成SRT、LRC和JSON对齐文件，时间来自合成时的词边界
+        self.subtitles_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(concurrent_frame, text="生成字幕", variable=self.subtitles_var).pack(side=tk.LEFT, padx=(10,0))
+        
         # 章节选择区域
         chapter_frame = ttk.LabelFrame(self.root, text="章节选择", padding="10")
         chapter_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
@@ -90,32 +146,11 @@ class EpubTTSGUI:
         
         ttk.Button(select_frame, text="全选", command=self.select_all_chapters).pack(side=tk.LEFT, padx=(0,5))
         ttk.Button(select_frame, text="取消全选", command=self.deselect_all_chapters).pack(side=tk.LEFT)
+        ttk.Label(select_frame, text="双击切换选择，Shift+单击选择范围", font=("", 8)).pack(side=tk.LEFT, padx=(10,0))
         
-        # 章节列表
-        list_container = ttk.Frame(chapter_frame)
-        list_container.pack(fill=tk.BOTH, expand=True)
-        
-        # 创建Treeview显示章节
-        columns = ("选择", "章节", "状态")
-        self.chapter_tree = ttk.Treeview(list_container, columns=columns, show="headings", height=12)
-        
-        self.chapter_tree.heading("选择", text="选择")
-        self.chapter_tree.heading("章节", text="章节")
-        self.chapter_tree.heading("状态", text="状态")
-        
-        self.chapter_tree.column("选择", width=60)
-        self.chapter_tree.column("章节", width=500)
-        self.chapter_tree.column("状态", width=100)
-        
-        # 滚动条
-        chapter_scrollbar = ttk.Scrollbar(list_container, orient=tk.VERTICAL, command=self.chapter_tree.yview)
-        self.chapter_tree.configure(yscrollcommand=chapter_scrollbar.set)
-        
-        self.chapter_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        chapter_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        
-        # 绑定双击事件切换选择状态
-        self.chapter_tree.bind("<Double-1>", self.toggle_chapter_selection)
+        # 章节列表：只显示可见的行，上万个章节也能立即打开
+        self.chapter_list = ChapterList(chapter_frame, height=12)
+        self.chapter_list.pack(fill=tk.BOTH, expand=True)
         
         # 控制按钮区域
         control_frame = ttk.Frame(self.root, padding="10")
@@ -179,49 +214,27 @@ class EpubTTSGUI:
     def load_chapters(self):
         """加载EPUB章节列表"""
         try:
-            temp_converter = EpubToTTS(self.epub_path, "temp")
-            self.chapters = temp_converter.get_toc_structure()
-            
-            # 清空现有列表
-            for item in self.chapter_tree.get_children():
-                self.chapter_tree.delete(item)
+            book, self.book = self.book, None
+            self.release_book(book)
+            self.book = BookIndex(self.epub_path)
+            self.chapters = self.book.chapters()
             
-            # 添加章节到列表
-            for chapter in self.chapters:
-                self.chapter_tree.insert("", "end", values=("☑", chapter['title'], "待转换"))
+            self.chapter_list.load(self.chapters)
             
         except Exception as e:
             messagebox.showerror("错误", f"读取EPUB章节失败: {str(e)}")
     
     def select_all_chapters(self):
         """全选章节"""
-        for item in self.chapter_tree.get_children():
-            values = list(self.chapter_tree.item(item)["values"])
-            values[0] = "☑"
-            self.chapter_tree.item(item, values=values)
+        self.chapter_list.select_all()
     
     def deselect_all_chapters(self):
         """取消全选章节"""
-        for item in self.chapter_tree.get_children():
-            values = list(self.chapter_tree.item(item)["values"])
-            values[0] = "☐"
-            self.chapter_tree.item(item, values=values)
-    
-    def toggle_chapter_selection(self, event):
-        """切换章节选择状态"""
-        item = self.chapter_tree.selection()[0]
-        values = list(self.chapter_tree.item(item)["values"])
-        values[0] = "☐" if values[0] == "☑" else "☑"
-        self.chapter_tree.item(item, values=values)
+        self.chapter_list.deselect_all()
     
     def get_selected_chapters(self):
         """获取选中的章节"""
-        selected_chapters = []
-        for i, item in enumerate(self.chapter_tree.get_children()):
-            values = self.chapter_tree.item(item)["values"]
-            if values[0] == "☑":
-                selected_chapters.append(self.chapters[i])
-        return selected_chapters
+        return self.chapter_list.selected_chapters()
     
     def select_output(self):
         dir_path = filedialog.askdirectory(title="选择输出目录")
@@ -259,113 +272,117 @@ class EpubTTSGUI:
             self.load_epub_file(files[0])
     
     def start_conversion(self):
-        print("=== 开始转换流程 ===")
+        logger.debug("=== 开始转换流程 ===")
         if not self.epub_path:
-            print("错误: 未选择EPUB文件")
+            logger.warning("错误: 未选择EPUB文件")
             messagebox.showerror("错误", "请选择EPUB文件")
             return
         
         output_path = self.output_var.get().strip()
-        print(f"EPUB路径: {self.epub_path}")
-        print(f"输出路径: {output_path}")
+        logger.info("EPUB路径: %s", self.epub_path)
+        logger.info("输出路径: %s", output_path)
         
         if not output_path:
-            print("错误: 未设置输出路径")
+            logger.warning("错误: 未设置输出路径")
             messagebox.showerror("错误", "请设置输出路径")
             return
         
         selected_chapters = self.get_selected_chapters()
-        print(f"选中章节数: {len(selected_chapters)}")
+        logger.info("选中章节数: %d", len(selected_chapters))
         
         if not selected_chapters:
-            print("错误: 未选择章节")
+            logger.warning("错误: 未选择章节")
             messagebox.showerror("错误", "请至少选择一个章节")
             return
         
-        print("设置运行状态...")
-        self.is_running = True
-        self.is_paused = False
+        concurrent = self.concurrent_var.get()
+        max_concurrent = None if concurrent == "自动" else int(concurrent)
+        logger.info("并发数: %s", max_concurrent)
+        
+        settings = {"book": self.book}
+        if self.longest_first_var.get():
+            settings["chapter_order"] = "longest-first"
+        if self.single_file_var.get() != "无":
+            settings["single_file"] = self.single_file_var.get().lower()
+        if self.subtitles_var.get():
+            settings["subtitle_formats"] = ("srt", "lrc", "json")
+        self.job = self.engine.submit(self.epub_path, output_path, select=lambda chapters: selected_chapters,
+                                      max_concurrent=max_concurrent, **settings)
+        logger.debug("转换任务已提交")
         self.update_button_states()
-        
-        print("启动转换线程...")
-        thread = threading.Thread(target=self.run_conversion, args=(selected_chapters, output_path))
-        thread.daemon = True
-        thread.start()
-        print("转换线程已启动")
 
-    def run_conversion(self, selected_chapters, output_path):
-        print(f"=== 转换线程开始 ===")
-        print(f"章节数: {len(selected_chapters)}")
-        print(f"输出目录: {output_path}")
-        
-        try:
-            max_concurrent = int(self.concurrent_var.get())
-            print(f"并发数: {max_concurrent}")
-            
-            print("创建转换器...")
-            self.converter = EpubToTTS(self.epub_path, output_path)
-            print("转换器创建成功")
-            
-            print("开始异步转换...")
-            asyncio.run(self.converter.convert_selected_chapters(selected_chapters, self.update_progress, max_concurrent))
-            print("转换完成")
-            
-        except Exception as e:
-            print(f"转换异常: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            messagebox.showerror("错误", f"转换失败: {str(e)}")
-        finally:
-            print("转换线程结束")
-            self.is_running = False
-            self.root.after(0, self.update_button_states)
+    def on_engine_event(self, event):
+        """引擎事件在引擎线程中发布，转到界面线程处理；进度事件先合并，每PROGRESS_INTERVAL毫秒刷新一次"""
+        job = event["job"]
+        if event["event"] != "progress":
+            self.root.after(0, self.handle_engine_event, event)
+            return
+        logger.debug("进度更新: %d/%d - %s - %s", event["completed"], event["total"], event["title"], event["status"])
+        with self._progress_lock:
+            self._pending_status[(job.id, event["chapter_id"])] = (job, event["chapter_id"], event["status"])
+            self._pending_totals = (job, event["completed"], event["total"], event["stats"])
+            if self._progress_scheduled:
+                return
+            self._progress_scheduled = True
+        self.root.after(PROGRESS_INTERVAL, self.flush_progress)
 
-    def update_progress(self, current, total, chapter_title, status):
-        print(f"进度更新: {current}/{total} - {chapter_title} - {status}")
-        def update_ui():
-            progress = (current / total) * 100 if total > 0 else 0
-            self.progress_var.set(progress)
-            self.progress_label.config(text=f"{current}/{total}")
-            
-            for item in self.chapter_tree.get_children():
-                values = list(self.chapter_tree.item(item)["values"])
-                if values[1] == chapter_title:
-                    values[2] = status
-                    self.chapter_tree.item(item, values=values)
-                    break
-        
-        self.root.after(0, update_ui)
+    def handle_engine_event(self, event):
+        self.flush_progress()  # 状态变化前先显示已到达的进度
+        job = event["job"]
+        if event["event"] == "finished" and job.settings.get("book") not in (None, self.book):
+            job.settings["book"].close()  # 转换期间界面已换成其他书，任务结束后关闭原来的书籍索引
+        if job is not self.job:
+            return  # 已被新的转换替换的任务
+        if event["event"] == "finished":
+            logger.info("转换结束: %s", job.state)
+            if job.state == "failed":
+                messagebox.showerror("错误", f"转换失败: {job.error}")
+            elif job.converter and job.converter.audiobook_path:
+                messagebox.showinfo("完成", f"有声书已生成: {job.converter.audiobook_path}")
+        self.update_button_states()
+
+    def flush_progress(self):
+        """在界面线程中应用合并后的进度：每个章节按id直接更新对应的行"""
+        with self._progress_lock:
+            pending, self._pending_status = self._pending_status, {}
+            totals, self._pending_totals = self._pending_totals, None
+            self._progress_scheduled = False
+        
+        for job, chapter_id, status in pending.values():
+            if job is self.job:
+                self.chapter_list.set_status(chapter_id, status)
+        if totals is not None and totals[0] is self.job:
+            self.update_progress(*totals)
+
+    def update_progress(self, job, current, total, stats=None):
+        progress = (current / total) * 100 if total > 0 else 0
+        self.progress_var.set(progress)
+        text = f"{current}/{total}"
+        if stats:
+            limit, chars_per_second, realtime_factor = stats
+            text += f"    并发: {limit}    速度: {chars_per_second:.0f} 字/秒"
+            text += f"    {realtime_factor:.1f} 倍实时"
+        self.progress_label.config(text=text)
     
     def pause_conversion(self):
-        self.is_paused = True
-        if self.converter:
-            self.converter.pause()
-        self.update_button_states()
+        if self.job:
+            self.engine.pause(self.job)
     
     def continue_conversion(self):
-        self.is_paused = False
-        if self.converter:
-            self.converter.resume()
-        self.update_button_states()
+        if self.job:
+            self.engine.resume(self.job)
     
     def restart_conversion(self):
         self.stop_conversion()
         # 重置章节状态
-        for item in self.chapter_tree.get_children():
-            values = list(self.chapter_tree.item(item)["values"])
-            if values[0] == "☑":
-                values[2] = "待转换"
-                self.chapter_tree.item(item, values=values)
+        self.chapter_list.reset_selected_status("待转换")
         self.progress_var.set(0)
         self.progress_label.config(text="0/0")
         self.start_conversion()
     
     def stop_conversion(self):
-        self.is_running = False
-        self.is_paused = False
-        if self.converter:
-            self.converter.stop()
-        self.update_button_states()
+        if self.job:
+            self.engine.cancel(self.job)
     
     def update_button_states(self):
         if self.is_running:
@@ -421,37 +438,32 @@ class EpubTTSGUI:
         if not save_path:
             return
         
-        try:
-            # 在单独线程中执行，避免阻塞UI和影响转换
-            def save_text_thread():
-                try:
-                    temp_converter = EpubToTTS(self.epub_path, "temp")
-                    
-                    with open(save_path, 'w', encoding='utf-8') as f:
-                        for i, chapter in enumerate(selected_chapters):
-                            f.write(f"=== 章节 {i+1}: {chapter['title']} ===\n\n")
-                            
-                            text = temp_converter.extract_chapter_text(chapter['href'])
-                            f.write(f"原始文本长度: {len(text)} 字符\n\n")
-                            f.write(text)
-                            f.write("\n\n" + "="*50 + "\n\n")
-                    
-                    # 在主线程中显示成功消息
-                    self.root.after(0, lambda: messagebox.showinfo("成功", f"文本已保存到: {save_path}"))
+        book = self.book  # 保存期间界面可能换成其他书，只读取选中章节所在的书
+        
+        def save_text():
+            with open(save_path, 'w', encoding='utf-8') as f:
+                for i, chapter in enumerate(selected_chapters):
+                    f.write(f"=== 章节 {i+1}: {chapter['title']} ===\n\n")
                     
-                except Exception as e:
-                    # 在主线程中显示错误消息
-                    self.root.after(0, lambda: messagebox.showerror("错误", f"保存文本失败: {str(e)}"))
-            
-            # 启动保存线程
-            save_thread = threading.Thread(target=save_text_thread)
-            save_thread.daemon = True
-            save_thread.start()
-            
-        except Exception as e:
-            messagebox.showerror("错误", f"保存文本失败: {str(e)}")
+                    text = book.chapter_text(chapter['href'])
+                    f.write(f"原始文本长度: {len(text)} 字符\n\n")
+                    f.write(text)
+                    f.write("\n\n" + "="*50 + "\n\n")
+        
+        def on_saved(future):
+            # 在主线程中显示结果
+            error = future.exception()
+            if error:
+                self.root.after(0, lambda: messagebox.showerror("错误", f"保存文本失败: {str(error)}"))
+            else:
+                self.root.after(0, lambda: messagebox.showinfo("成功", f"文本已保存到: {save_path}"))
+        
+        # 在引擎的线程池中执行，不阻塞UI
+        self.engine.run_in_background(save_text).add_done_callback(on_saved)
 
 if __name__ == "__main__":
+    # 设置环境变量EPUB_TTS_LOG=DEBUG可查看详细日志
+    logging.basicConfig(level=os.environ.get("EPUB_TTS_LOG", "INFO").upper(), format="%(asctime)s %(levelname)s %(message)s")
     if DND_AVAILABLE:
         root = TkinterDnD.Tk()
     else:
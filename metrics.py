@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+def percentile(values, q):
+    """已排序列表的分位数（线性插值）"""
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class Metrics:
+    """一次转换的统计：各阶段耗时分布、计数器，可导出JSON汇总和Chrome/Perfetto trace
+
+    时间统一使用time.perf_counter()，解析进程中记录的时间也可以直接合并。
+    enabled=False时所有记录都是空操作。
+    """
+
+    def __init__(self, enabled=True, trace=True):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.durations = {}  # 阶段 -> 每次耗时(秒)
+        self.counters = {}
+        self.events = [] if enabled and trace else None  # trace事件
+        self._lanes = {}  # 阶段 -> 正在使用的泳道号
+        self._lane_ids = {}  # (阶段, 泳道号) -> trace中的tid
+        self._lane_of = {}  # tid -> 泳道号
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, stage, start, duration, pid=None, tid=None, args=None):
+        """记录一次已完成的阶段，start为perf_counter时间"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.durations.setdefault(stage, []).append(duration)
+            if self.events is not None:
+                event = {
+                    "name": stage, "cat": stage, "ph": "X",
+                    "ts": round((start - self.started) * 1e6, 1), "dur": round(duration * 1e6, 1),
+                    "pid": pid or os.getpid(), "tid": tid or threading.get_ident(),
+                }
+                if args:
+                    event["args"] = args
+                self.events.append(event)
+
+    @contextmanager
+    def span(self, stage, lane=False, **args):
+        """计时一个阶段；lane=True用于会互相重叠的异步阶段（如TTS请求），在trace中分配独立泳道"""
+        if not self.enabled:
+            yield
+            return
+        tid = self._acquire_lane(stage) if lane else None
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            args["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(stage, start, time.perf_counter() - start, tid=tid, args=args)
+            if lane:
+                self._release_lane(stage, tid)
+
+    def _acquire_lane(self, stage):
+        with self._lock:
+            used = self._lanes.setdefault(stage, set())
+            lane = 0
+            while lane in used:
+                lane += 1
+            used.add(lane)
+            if (stage, lane) not in self._lane_ids:
+                tid = len(self._lane_ids) + 1
+                self._lane_ids[(stage, lane)] = tid
+                self._lane_of[tid] = lane
+                if self.events is not None:
+                    self.events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                                        "args": {"name": f"{stage} #{lane + 1}"}})
+            return self._lane_ids[(stage, lane)]
+
+    def _release_lane(self, stage, tid):
+        with self._lock:
+            self._lanes[stage].discard(self._lane_of[tid])
+
+    def rate(self, name):
+        """计数器每秒的增量（从开始统计算起），如rate("audio_seconds")即实时倍率"""
+        elapsed = time.perf_counter() - self.started
+        return self.counters.get(name, 0) / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        """各阶段耗时分布（秒）、计数器和派生指标"""
+        elapsed = time.perf_counter() - self.started
+        with self._lock:
+            durations = {stage: sorted(values) for stage, values in self.durations.items()}
+            counters = dict(self.counters)
+
+        stages = {}
+        for stage, values in durations.items():
+            total = sum(values)
+            stages[stage] = {
+                "count": len(values),
+                "total": round(total, 4),
+                "mean": round(total / len(values), 4),
+                "p50": round(percentile(values, 0.50), 4),
+                "p95": round(percentile(values, 0.95), 4),
+                "p99": round(percentile(values, 0.99), 4),
+                "max": round(values[-1], 4),
+            }
+        audio_seconds = counters.get("audio_seconds", 0.0)
+        return {
+            "started_at": self.started_at,
+            "elapsed_seconds": round(elapsed, 3),
+            "chars_per_second": round(counters.get("chars", 0) / elapsed, 1) if elapsed else 0.0,
+            "audio_seconds": round(audio_seconds, 3),
+            "realtime_factor": round(audio_seconds / elapsed, 2) if elapsed else 0.0,  # 每秒墙钟时间产出的音频秒数
+            "bytes_written": counters.get("bytes_written", 0),
+            "stages": stages,
+            "counters": counters,
+        }
+
+    def write_summary(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+
+    def write_trace(self, path):
+        """Chrome trace事件格式，可用chrome://tracing或ui.perfetto.dev打开"""
+        with self._lock:
+            events = list(self.events or ())
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+    def export(self, directory):
+        """在目录中写入本次运行的汇总和trace文件，返回(汇总路径, trace路径)"""
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started_at))
+        summary_path = os.path.join(directory, f"run-{stamp}.json")
+        trace_path = os.path.join(directory, f"run-{stamp}.trace.json")
+        self.write_summary(summary_path)
+        self.write_trace(trace_path)
+        return summary_path, trace_path
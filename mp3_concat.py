@@ -0,0 +1,277 @@
+import mmap
+import os
+import struct
+from array import array
+from collections import namedtuple
+
+# MPEG Layer III 比特率表 (kbps)，索引0为free格式，15为无效
+BITRATES_V1 = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+BITRATES_V2 = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG1
+    2: [22050, 24000, 16000],  # MPEG2
+    0: [11025, 12000, 8000],   # MPEG2.5
+}
+
+XING_FRAMES = 0x1
+XING_BYTES = 0x2
+XING_TOC = 0x4
+
+Frame = namedtuple('Frame', 'version bitrate_index sample_rate_index padding channel_mode length')
+
+
+def parse_frame_header(data, pos):
+    """解析pos处的Layer III帧头，不是有效帧头时返回None"""
+    if pos + 4 > len(data):
+        return None
+    b0, b1, b2, b3 = data[pos], data[pos + 1], data[pos + 2], data[pos + 3]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+
+    version = (b1 >> 3) & 0x3
+    layer = (b1 >> 1) & 0x3
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    padding = (b2 >> 1) & 0x1
+    channel_mode = b3 >> 6
+    length = frame_length(version, bitrate_index, sample_rate_index, padding)
+    return Frame(version, bitrate_index, sample_rate_index, padding, channel_mode, length)
+
+
+def frame_length(version, bitrate_index, sample_rate_index, padding):
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    if version == 3:
+        return 144000 * BITRATES_V1[bitrate_index] // sample_rate + padding
+    return 72000 * BITRATES_V2[bitrate_index] // sample_rate + padding
+
+
+def samples_per_frame(frame):
+    return 1152 if frame.version == 3 else 576
+
+
+def frame_sample_rate(frame):
+    return SAMPLE_RATES[frame.version][frame.sample_rate_index]
+
+
+def side_info_size(frame):
+    mono = frame.channel_mode == 3
+    if frame.version == 3:
+        return 17 if mono else 32
+    return 9 if mono else 17
+
+
+def is_info_frame(data, pos, frame):
+    """帧内是否为Xing/Info/VBRI信息帧（不含音频）"""
+    xing_pos = pos + 4 + side_info_size(frame)
+    if bytes(data[xing_pos:xing_pos + 4]) in (b'Xing', b'Info'):
+        return True
+    return bytes(data[pos + 36:pos + 40]) == b'VBRI'
+
+
+def id3v2_size(data, pos):
+    """pos处ID3v2标签的总长度，不是标签时返回0"""
+    if bytes(data[pos:pos + 3]) != b'ID3' or pos + 10 > len(data):
+        return 0
+    size = 0
+    for b in data[pos + 6:pos + 10]:
+        size = (size << 7) | (b & 0x7F)
+    footer = 10 if data[pos + 5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def iter_audio_frames(data, start=0, end=None):
+    """遍历数据中的音频帧，跳过ID3标签、信息帧和无法识别的字节，产出(偏移, 帧)"""
+    end = len(data) if end is None else end
+    pos = start
+    first = True  # 信息帧只会出现在每段数据的第一帧
+    while pos + 4 <= end:
+        tag_size = id3v2_size(data, pos)
+        if tag_size:
+            pos += tag_size
+            first = True
+            continue
+        if bytes(data[pos:pos + 3]) == b'TAG' and end - pos == 128:
+            break  # 结尾的ID3v1标签
+
+        frame = parse_frame_header(data, pos)
+        if frame is None or pos + frame.length > end:
+            pos += 1  # 失去同步，逐字节查找下一个帧头
+            continue
+        if not (first and is_info_frame(data, pos, frame)):
+            yield pos, frame
+        first = False
+        pos += frame.length
+
+
+def audio_runs(data):
+    """把连续的音频帧合并成区间，返回([(起点, 终点)], 帧列表)"""
+    runs = []
+    frames = []
+    for pos, frame in iter_audio_frames(data):
+        frames.append(frame)
+        if runs and runs[-1][1] == pos:
+            runs[-1][1] = pos + frame.length
+        else:
+            runs.append([pos, pos + frame.length])
+    return runs, frames
+
+
+def copy_range(src_fd, data, start, end, file, position):
+    """把源文件（data为其mmap）中[start, end)复制到file的position处，返回复制后的位置
+
+    优先用copy_file_range在内核中直接复制，文件系统不支持时退回普通写入
+    """
+    if hasattr(os, 'copy_file_range'):
+        dst_fd = file.fileno()
+        while start < end:
+            try:
+                copied = os.copy_file_range(src_fd, dst_fd, end - start, start, position)
+            except OSError:
+                break
+            if copied == 0:
+                break
+            start += copied
+            position += copied
+        if start == end:
+            return position
+    file.seek(position)
+    with memoryview(data) as view:
+        file.write(view[start:end])
+    return position + end - start
+
+
+class Mp3Writer:
+    """按帧拼接MP3，不解码：去掉各段自带的ID3标签和Xing/Info帧，并在音频开头写入一个正确的Xing/Info头
+
+    base为音频在文件中的起点，之前的部分留给调用者（如之后写入的ID3标签）
+    """
+
+    TOC_STRIDE = 64  # 每隔多少帧记录一次偏移，用于生成Xing目录表
+
+    def __init__(self, file, resume_offset=0, base=0):
+        self.file = file
+        self.base = base
+        self.first_frame = None
+        self.header_size = 0
+        self.position = base
+        self.frame_count = 0
+        self.bitrates = set()
+        self.offsets = array('Q')
+        if resume_offset:
+            self._resume(resume_offset)
+
+    def _resume(self, offset):
+        """重新扫描已写入的部分（只读帧头），恢复帧数和偏移表；开头的Xing/Info头在finish时重写"""
+        self.file.flush()
+        with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header = parse_frame_header(data, 0)
+            if header is None or not is_info_frame(data, 0, header):
+                raise ValueError("已有文件开头没有Xing/Info头，无法续写")
+            self.first_frame = header
+            self.header_size = header.length
+            for pos, frame in iter_audio_frames(data, self.header_size, offset):
+                self._count_at(pos, frame)
+        self.position = offset
+        self.file.seek(offset)
+
+    def _start(self, frame):
+        """遇到第一帧时先写入一个临时的Info头（帧数为0），进程中途被杀死时文件仍可续写"""
+        self.first_frame = frame
+        header = self._xing_frame(frame, 0, 0, bytes(100), xing=False)
+        self.header_size = len(header)
+        self.file.seek(self.base)
+        self.file.write(header)
+        self.position = self.base + self.header_size
+
+    def append_bytes(self, data):
+        """追加一段内存中的MP3数据，返回写入的音频帧数"""
+        data = memoryview(data)
+        runs, frames = audio_runs(data)
+        if not frames:
+            raise ValueError("不是有效的MP3数据")
+        self._add_frames(runs, frames)
+        for start, end in runs:
+            self.file.write(data[start:end])
+        self.position = self.file.tell()
+        return len(frames)
+
+    def append_file(self, path):
+        """追加一个MP3文件，优先用copy_file_range在内核中直接复制音频帧，返回写入的音频帧数"""
+        with open(path, 'rb') as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                raise ValueError(f"空的MP3文件: {path}")
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                runs, frames = audio_runs(data)
+                if not frames:
+                    raise ValueError(f"不是有效的MP3文件: {path}")
+                self._add_frames(runs, frames)
+                self.file.flush()
+                for start, end in runs:
+                    self.position = copy_range(infile.fileno(), data, start, end, self.file, self.position)
+        self.file.seek(self.position)
+        return len(frames)
+
+    def _add_frames(self, runs, frames):
+        if self.first_frame is None:
+            self._start(frames[0])
+        pos = self.position
+        index = 0
+        for start, end in runs:
+            offset = start
+            while offset < end:
+                self._count_at(pos + offset - start, frames[index])
+                offset += frames[index].length
+                index += 1
+            pos += end - start
+
+    def _count_at(self, pos, frame):
+        if self.frame_count % self.TOC_STRIDE == 0:
+            self.offsets.append(pos - self.base)
+        self.frame_count += 1
+        self.bitrates.add(frame.bitrate_index)
+
+    def duration(self):
+        """已写入音频的时长（秒）"""
+        if self.first_frame is None:
+            return 0.0
+        return self.frame_count * samples_per_frame(self.first_frame) / frame_sample_rate(self.first_frame)
+
+    def finish(self):
+        """在文件开头写入最终的Xing/Info头"""
+        if self.first_frame is None:
+            return
+        self.file.flush()
+        total_bytes = self.position - self.base
+        toc = bytearray(100)
+        for i in range(100):
+            frame_index = self.frame_count * i // 100
+            offset = self.offsets[min(frame_index // self.TOC_STRIDE, len(self.offsets) - 1)]
+            toc[i] = min(255, offset * 256 // max(total_bytes, 1))
+
+        header = self._xing_frame(self.first_frame, self.frame_count, total_bytes, bytes(toc),
+                                  xing=len(self.bitrates) > 1)
+        self.file.seek(self.base)
+        self.file.write(header)
+        self.file.seek(self.position)
+        self.file.flush()
+
+    def _xing_frame(self, frame, frame_count, total_bytes, toc, xing):
+        """构造Xing(VBR)或Info(CBR)帧，选择足够容纳目录表的最小比特率"""
+        body = b'Xing' if xing else b'Info'
+        body += struct.pack('>III', XING_FRAMES | XING_BYTES | XING_TOC, frame_count, total_bytes) + toc
+        needed = 4 + side_info_size(frame) + len(body)
+        for bitrate_index in range(1, 15):
+            length = frame_length(frame.version, bitrate_index, frame.sample_rate_index, 0)
+            if length >= needed:
+                break
+        else:
+            raise ValueError("无法构造Xing帧")
+
+        b1 = 0xE0 | (frame.version << 3) | (1 << 1) | 1  # Layer III，无CRC
+        b2 = (bitrate_index << 4) | (frame.sample_rate_index << 2)
+        b3 = frame.channel_mode << 6
+        header = bytes([0xFF, b1, b2, b3]) + bytes(side_info_size(frame)) + body
+        return header + bytes(length - len(header))
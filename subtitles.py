@@ -0,0 +1,171 @@
+"""章节字幕和对齐文件：用合成时收到的词边界时间生成SRT、LRC和JSON，不需要再做强制对齐
+
+每段的词边界时间相对于该段音频的开头，拼接章节时加上该段在章节中的起始时间；
+没有词边界的段（本地引擎或旧的缓存）按字数在段的时长内估算每句的时间。
+"""
+import json
+import logging
+import os
+import re
+from collections import namedtuple
+
+from text_chunker import CLAUSE_END, SENTENCE_END, split_at
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("srt", "lrc", "json")
+
+# 章节中已写入的一段：start和end为在章节音频中的秒数，boundaries为tts_backends.Boundary列表，None时没有词边界
+ChunkTiming = namedtuple('ChunkTiming', 'index text start end boundaries')
+Cue = namedtuple('Cue', 'start end text estimated')
+
+MAX_CUE_CHARS = 32  # 超过这个长度就在下一个词处断开
+MIN_CUE_CHARS = 12  # 达到这个长度后在逗号等分句处断开
+MAX_CUE_SECONDS = 7.0
+
+STRONG_BREAK = re.compile(r'[。！？!?…]|\.(?=\s|$)|\n')
+WEAK_BREAK = re.compile(r'[，、；：,;:]|—|--')
+
+
+def subtitle_path(audio_path, fmt):
+    """章节音频旁边的字幕文件路径"""
+    return f"{os.path.splitext(audio_path)[0]}.{fmt}"
+
+
+def clean(text):
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def visible_length(text):
+    return len(re.sub(r'\s', '', text))
+
+
+def timed_cues(timing):
+    """按词边界生成字幕：词在段文本中依次定位，断句处的标点留在字幕中"""
+    text = timing.text
+    words = []  # (开始秒数, 结束秒数, 文本中的起点, 终点)
+    pos = 0
+    for boundary in timing.boundaries:
+        found = text.find(boundary.text, pos) if boundary.text else -1
+        if found < 0:
+            start_char = end_char = pos  # 服务返回的词与原文不一致（如数字读法），只用时间
+        else:
+            start_char, end_char = found, found + len(boundary.text)
+            pos = end_char
+        start = min(timing.start + boundary.start, timing.end)
+        end = min(timing.start + boundary.start + boundary.duration, timing.end)
+        words.append((start, end, start_char, end_char))
+    if not words:
+        return estimated_cues(timing)
+
+    cues = []
+    cue_first = 0  # 当前字幕的第一个词
+    region_start = 0  # 当前字幕在段文本中的起点
+    for k, (start, end, start_char, end_char) in enumerate(words):
+        is_last = k == len(words) - 1
+        next_start_char = len(text) if is_last else words[k + 1][2]
+        gap = text[end_char:next_start_char]
+        length = visible_length(text[region_start:next_start_char])
+        duration = end - words[cue_first][0]
+        if not (is_last or STRONG_BREAK.search(gap) or (WEAK_BREAK.search(gap) and length >= MIN_CUE_CHARS)
+                or length >= MAX_CUE_CHARS or duration >= MAX_CUE_SECONDS):
+            continue
+        cue_text = clean(text[region_start:next_start_char])
+        if cue_text:
+            cues.append(Cue(words[cue_first][0], end, cue_text, False))
+        cue_first = k + 1
+        region_start = next_start_char
+    return cues
+
+
+def estimated_cues(timing):
+    """没有词边界时按句（过长的句按分句）切开，按字数在段的时长内分配时间"""
+    sentences = []
+    for sentence in split_at(timing.text, SENTENCE_END):
+        if visible_length(sentence) > MAX_CUE_CHARS:
+            sentences.extend(split_at(sentence, CLAUSE_END))
+        else:
+            sentences.append(sentence)
+    sentences = [clean(sentence) for sentence in sentences if clean(sentence)]
+    total = sum(visible_length(sentence) for sentence in sentences) or 1
+    cues = []
+    elapsed = 0
+    for sentence in sentences:
+        start = timing.start + (timing.end - timing.start) * elapsed / total
+        elapsed += visible_length(sentence)
+        end = timing.start + (timing.end - timing.start) * elapsed / total
+        cues.append(Cue(start, end, sentence, True))
+    return cues
+
+
+def build_cues(timings):
+    """所有已写入段的字幕，按时间顺序"""
+    cues = []
+    for timing in timings:
+        cues.extend(timed_cues(timing) if timing.boundaries else estimated_cues(timing))
+    return cues
+
+
+def srt_time(seconds):
+    millis = round(seconds * 1000)
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d},{millis:03d}"
+
+
+def lrc_time(seconds):
+    centis = round(seconds * 100)
+    minutes, centis = divmod(centis, 6000)
+    secs, centis = divmod(centis, 100)
+    return f"{minutes:02d}:{secs:02d}.{centis:02d}"
+
+
+def format_srt(cues):
+    return "".join(f"{i}\n{srt_time(cue.start)} --> {srt_time(cue.end)}\n{cue.text}\n\n"
+                   for i, cue in enumerate(cues, 1))
+
+
+def format_lrc(cues):
+    lines = [f"[{lrc_time(cue.start)}]{cue.text}" for cue in cues]
+    if cues:
+        lines.append(f"[{lrc_time(cues[-1].end)}]")  # 最后一句的结束时间
+    return "\n".join(lines) + "\n"
+
+
+def format_json(cues, timings):
+    """对齐数据：字幕（estimated为按字数估算的时间）和服务返回的每个词的时间"""
+    words = [{"start": round(timing.start + boundary.start, 3),
+              "end": round(min(timing.start + boundary.start + boundary.duration, timing.end), 3),
+              "text": boundary.text}
+             for timing in timings if timing.boundaries for boundary in timing.boundaries]
+    data = {
+        "duration": round(timings[-1].end, 3) if timings else 0.0,
+        "cues": [{"start": round(cue.start, 3), "end": round(cue.end, 3), "text": cue.text,
+                  "estimated": cue.estimated} for cue in cues],
+        "words": words,
+    }
+    return json.dumps(data, ensure_ascii=False, indent=1) + "\n"
+
+
+def write_subtitles(audio_path, formats, timings):
+    """在章节音频旁边写入字幕文件，返回写入的路径"""
+    cues = build_cues(timings)
+    written = []
+    for fmt in formats:
+        if fmt == "srt":
+            content = format_srt(cues)
+        elif fmt == "lrc":
+            content = format_lrc(cues)
+        elif fmt == "json":
+            content = format_json(cues, timings)
+        else:
+            raise ValueError(f"不支持的字幕格式: {fmt}")
+        path = subtitle_path(audio_path, fmt)
+        temp_path = path + ".part"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+        written.append(path)
+    logger.debug("字幕已写入: %s (%d 条)", ", ".join(written), len(cues))
+    return written
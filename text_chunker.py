@@ -0,0 +1,148 @@
+import re
+from collections import Counter
+
+# edge_tts把转义后的文本按4096字节切分成多次请求，留一点余量让每段正好是一次请求
+MAX_CHUNK_BYTES = 4000
+
+CLOSING = r'["\'”’」』）)\]】》]*'
+# 句末：中西文句号、问号、叹号、省略号（西文句点后需跟空白），以及换行；后面的引号和括号留在本句
+SENTENCE_END = re.compile(r'(?:[。！？!?…]+|\.+(?=\s|$)|\n)' + CLOSING + r'\s*')
+# 分句：逗号、顿号、分号、冒号、破折号
+CLAUSE_END = re.compile(r'(?:[，、；：,;:]|——|—|--)' + CLOSING + r'\s*')
+# 更短的重复句子（对话、“本章完”）单独成段省不下请求，不算作重复段落
+BOILERPLATE_MIN_BYTES = 100
+
+
+def text_bytes(text):
+    """文本在TTS请求中的字节数（UTF-8编码，& < > 会被转义）"""
+    return len(text.encode('utf-8')) + 4 * text.count('&') + 3 * (text.count('<') + text.count('>'))
+
+
+def split_at(text, pattern):
+    """按分隔符切开文本，分隔符和其后的引号、空白留在前一部分"""
+    start = 0
+    for match in pattern.finditer(text):
+        if match.end() > start:
+            yield text[start:match.end()]
+            start = match.end()
+    if start < len(text):
+        yield text[start:]
+
+
+def hard_cut(text, max_bytes):
+    """没有标点可用时按字节数强制切开，尽量在空白处断开"""
+    start = 0
+    size = 0
+    last_space = -1
+    for i, char in enumerate(text):
+        char_size = text_bytes(char)
+        if size + char_size > max_bytes and i > start:
+            cut = last_space + 1 if last_space > start else i
+            yield text[start:cut]
+            start = cut
+            size = text_bytes(text[cut:i])
+            last_space = -1
+        size += char_size
+        if char.isspace():
+            last_space = i
+    if start < len(text):
+        yield text[start:]
+
+
+def pieces(text, max_bytes):
+    """把文本拆成不超过max_bytes的片段：先按句，过长的句按分句，仍过长的强制切开"""
+    for sentence in split_at(text, SENTENCE_END):
+        size = text_bytes(sentence)
+        if size <= max_bytes:
+            yield sentence, size
+            continue
+        for clause in split_at(sentence, CLAUSE_END):
+            size = text_bytes(clause)
+            if size <= max_bytes:
+                yield clause, size
+                continue
+            for part in hard_cut(clause, max_bytes):
+                yield part, text_bytes(part)
+
+
+def pack(text, max_bytes):
+    """一次遍历把文本分成尽量接近max_bytes的段"""
+    chunks = []
+    current = []
+    current_size = 0
+    for piece, size in pieces(text, max_bytes):
+        if current and current_size + size > max_bytes:
+            chunks.append(''.join(current).strip())
+            current = []
+            current_size = 0
+        current.append(piece)
+        current_size += size
+    if current:
+        chunks.append(''.join(current).strip())
+    return [chunk for chunk in chunks if chunk]
+
+
+def repeated_runs(sentences, counts):
+    """连续的、在counts中计数大于1的句子，产出句子元组"""
+    run = []
+    for sentence in sentences + ['']:
+        if sentence and counts[sentence] > 1:
+            run.append(sentence)
+        elif run:
+            yield tuple(run)
+            run = []
+
+
+def find_boilerplate(texts, min_bytes=BOILERPLATE_MIN_BYTES):
+    """找出在不止一章中出现的段落（连续的重复句子，如页眉、页脚、版权声明、译者注），返回句子元组的集合
+
+    按出现在几章中计数，同一章内重复的句子不算
+    """
+    split = [[sentence.strip() for sentence in split_at(text, SENTENCE_END)] for text in texts]
+    counts = Counter(sentence for sentences in split for sentence in set(sentences) if sentence)
+    runs = Counter(run for sentences in split for run in set(repeated_runs(sentences, counts)))
+    return {run for run, count in runs.items() if count > 1 and text_bytes(''.join(run)) >= min_bytes}
+
+
+def boilerplate_segments(text, boilerplate):
+    """把文本切成[(片段, 是否为重复段落)]，重复段落按最长匹配"""
+    sentences = list(split_at(text, SENTENCE_END))
+    stripped = [sentence.strip() for sentence in sentences]
+    by_first = {}
+    for run in sorted(boilerplate, key=len, reverse=True):
+        by_first.setdefault(run[0], []).append(run)
+    segments = []
+    start = i = 0
+    while i < len(sentences):
+        match = next((run for run in by_first.get(stripped[i], ())
+                      if tuple(stripped[i:i + len(run)]) == run), None)
+        if match is None:
+            i += 1
+            continue
+        if start < i:
+            segments.append((''.join(sentences[start:i]), False))
+        segments.append((''.join(sentences[i:i + len(match)]), True))
+        i += len(match)
+        start = i
+    if start < len(sentences):
+        segments.append((''.join(sentences[start:]), False))
+    return segments
+
+
+def split_text(text, max_bytes=MAX_CHUNK_BYTES, boilerplate=None):
+    """一次遍历把文本分成尽量接近max_bytes的段，保留原有标点，每段都不超过max_bytes
+
+    boilerplate为find_boilerplate的结果时，重复段落单独成段，各章中得到相同的段，可以命中缓存或与正在合成的请求合并；
+    只在这样能减少本章需要单独合成的段数时才拆开，否则按原样分段
+    """
+    chunks = pack(text, max_bytes)
+    if not boilerplate:
+        return chunks
+    segments = boilerplate_segments(text, boilerplate)
+    if not any(is_boilerplate for _, is_boilerplate in segments):
+        return chunks
+    packed = [(pack(segment, max_bytes), is_boilerplate) for segment, is_boilerplate in segments]
+    unique = sum(len(parts) for parts, is_boilerplate in packed if not is_boilerplate)
+    if unique >= len(chunks):
+        return chunks
+    return [chunk for parts, _ in packed for chunk in parts]
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from book_index import parse_epub_document
+
+logger = logging.getLogger(__name__)
+
+
+class TextExtractor:
+    """文本提取流水线：在进程池中解析章节文档，不阻塞事件循环中的TTS请求"""
+
+    def __init__(self, book, max_workers=None, lookahead=8):
+        self.book = book
+        self.max_workers = max_workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+        self.lookahead = lookahead  # 提前解析后续多少个章节的文档
+        self.executor = None
+        self.pending = {}  # 文档路径 -> 解析中的future
+
+    def start(self):
+        try:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        except (OSError, NotImplementedError) as e:
+            logger.warning("无法创建解析进程池，改用线程: %s", e)
+            self.executor = None
+
+    def close(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def prefetch(self, path):
+        """提交文档解析任务（已解析或正在解析的文档跳过）"""
+        if path in self.pending or self.book.has_document(path):
+            return
+        loop = asyncio.get_running_loop()
+        backend = self.book.backend_for(path)
+        if self.executor:
+            future = loop.run_in_executor(self.executor, parse_epub_document,
+                                          self.book.epub_path, path, backend)
+        else:
+            future = loop.run_in_executor(None, self.book.document, path)
+        self.pending[path] = future
+
+    async def load(self, path):
+        """等待文档解析完成并回填到书籍索引"""
+        self.prefetch(path)
+        future = self.pending.get(path)
+        if future is None:
+            return
+        try:
+            parsed = await future
+            if self.executor:
+                parsed, timings = parsed
+                for stage, start, duration, pid in timings:
+                    self.book.metrics.record(stage, start, duration, pid=pid, tid=pid, args={"path": path})
+                self.book.set_document(path, parsed)
+        except BrokenProcessPool as e:
+            logger.warning("解析进程池异常，改用线程: %s", e)
+            self.executor = None
+            await asyncio.get_running_loop().run_in_executor(None, self.book.document, path)
+        finally:
+            self.pending.pop(path, None)
+
+    async def chapter_texts(self, chapters):
+        """按顺序产出(索引, 章节, 文本)，同时在后台解析后续章节的文档"""
+        for index, chapter in enumerate(chapters):
+            for upcoming in chapters[index:index + self.lookahead]:
+                self.prefetch(upcoming['href'].partition('#')[0])
+
+            path = chapter['href'].partition('#')[0]
+            try:
+                await self.load(path)
+                text = self.book.chapter_text(chapter['href'])
+            except Exception as e:
+                logger.error("提取章节文本时发生异常: %s, %s", chapter['title'], e)
+                text = ""
+            yield index, chapter, text
@@ -0,0 +1,233 @@
+"""TTS后端：Edge在线服务和调用本地命令行合成器的离线引擎
+
+所有后端输出相同格式的MP3（24kHz、48kbps、单声道），章节文件可以按帧直接拼接，
+不同后端生成的段也可以共用缓存目录（缓存键包含后端的output_format）。
+"""
+import asyncio
+import io
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from mp3_concat import id3v2_size, parse_frame_header
+from text_chunker import MAX_CHUNK_BYTES
+
+MP3_BITRATE = "48k"
+MP3_SAMPLE_RATE = 24000
+TICKS_PER_SECOND = 10_000_000  # 边界事件的时间单位为100纳秒
+
+# 一个词的时间：start和duration为相对于该段音频开头的秒数
+Boundary = namedtuple('Boundary', 'start duration text')
+# 合成结果：boundaries为词边界列表，后端不提供时为None
+Synthesis = namedtuple('Synthesis', 'audio boundaries')
+
+
+class TTSBackend:
+    """TTS后端接口
+
+    子类至少实现synthesize或stream之一：
+      synthesize(text, voice, rate, volume, pitch) -> MP3数据
+      stream(...) -> 异步产出{"type": "audio", "data": bytes}（以及边界事件）
+    word_boundaries为True的后端在stream中产出WordBoundary事件（offset、duration以100纳秒为单位）
+    """
+
+    name = ""
+    output_format = ""  # 用于缓存键，不同后端或不同输出格式的音频不会混用
+    default_voice = ""
+    max_payload_bytes = MAX_CHUNK_BYTES  # 每段文本的最大字节数
+    adaptive = True  # 是否根据延迟和错误自动调整并发（远程服务）
+    recommended_concurrency = 6  # 不自动调整时使用的并发数
+    max_concurrency = 16
+    timeout = 60.0  # 单次合成的超时（秒）
+    word_boundaries = False  # 合成时是否同时返回每个词的时间
+
+    async def synthesize(self, text, voice, rate="+0%", volume="+0%", pitch="+0Hz"):
+        audio = bytearray()
+        async for chunk in self.stream(text, voice, rate, volume, pitch):
+            if chunk["type"] == "audio":
+                audio += chunk["data"]
+        return bytes(audio)
+
+    async def stream(self, text, voice, rate="+0%", volume="+0%", pitch="+0Hz"):
+        yield {"type": "audio", "data": await self.synthesize(text, voice, rate, volume, pitch)}
+
+    async def synthesize_timed(self, text, voice, rate="+0%", volume="+0%", pitch="+0Hz"):
+        """合成一段文本，同时收集流中的词边界，返回Synthesis"""
+        if not self.word_boundaries:
+            return Synthesis(await self.synthesize(text, voice, rate, volume, pitch), None)
+        audio = bytearray()
+        boundaries = []
+        async for chunk in self.stream(text, voice, rate, volume, pitch):
+            if chunk["type"] == "audio":
+                audio += chunk["data"]
+            elif chunk["type"] == "WordBoundary":
+                boundaries.append(Boundary(chunk["offset"] / TICKS_PER_SECOND, chunk["duration"] / TICKS_PER_SECOND,
+                                           chunk["text"]))
+        return Synthesis(bytes(audio), boundaries)
+
+    async def voices(self):
+        """可用语音列表，每项包含name、locale、gender"""
+        return []
+
+    def close(self):
+        pass
+
+
+class EdgeBackend(TTSBackend):
+    """Microsoft Edge在线TTS服务"""
+
+    name = "edge"
+    output_format = "audio-24khz-48kbitrate-mono-mp3"  # edge_tts固定输出格式
+    default_voice = "zh-CN-XiaoxiaoNeural"
+    word_boundaries = True
+
+    async def stream(self, text, voice, rate="+0%", volume="+0%", pitch="+0Hz"):
+        import edge_tts  # 依赖aiohttp，导入较慢，第一次合成时才导入
+        # 服务在同一次请求中返回每个词的时间，字幕和对齐直接使用
+        communicate = edge_tts.Communicate(text, voice, rate=rate, volume=volume, pitch=pitch,
+                                           boundary="WordBoundary")
+        async for chunk in communicate.stream():
+            yield chunk
+
+    async def voices(self):
+        import edge_tts
+        voices = await edge_tts.list_voices()
+        return [{"name": v["ShortName"], "locale": v["Locale"], "gender": v["Gender"]} for v in voices]
+
+
+def percent(value):
+    """"+10%"这样的参数转换为整数"""
+    match = re.match(r'^([+-]?\d+)', value or "")
+    return int(match.group(1)) if match else 0
+
+
+def is_mp3(data):
+    return bool(id3v2_size(data, 0)) or parse_frame_header(data, 0) is not None
+
+
+def encode_mp3(data):
+    """把合成器输出的音频（WAV等）转换为统一格式的MP3，需要ffmpeg"""
+    from pydub import AudioSegment
+    segment = AudioSegment.from_file(io.BytesIO(data))
+    segment = segment.set_frame_rate(MP3_SAMPLE_RATE).set_channels(1)
+    output = io.BytesIO()
+    segment.export(output, format="mp3", bitrate=MP3_BITRATE)
+    return output.getvalue()
+
+
+def run_command(command, output_suffix, text, fields, timeout):
+    """在进程池中执行：调用命令行合成器，返回MP3数据"""
+    with tempfile.TemporaryDirectory(prefix="epub_tts_") as workdir:
+        text_file = os.path.join(workdir, "input.txt")
+        output = os.path.join(workdir, "output" + output_suffix)
+        with open(text_file, 'w', encoding='utf-8') as f:
+            f.write(text)
+        values = dict(fields, text=text, text_file=text_file, output=output)
+        args = [part.format(**values) for part in command]
+        completed = subprocess.run(args, capture_output=True, timeout=timeout)
+        if completed.returncode != 0:
+            message = completed.stderr.decode('utf-8', errors='replace').strip()
+            raise RuntimeError(f"{args[0]} 退出码 {completed.returncode}: {message[-200:]}")
+        with open(output, 'rb') as f:
+            data = f.read()
+    if not data:
+        raise RuntimeError(f"{command[0]} 没有输出音频")
+    return data if is_mp3(data) else encode_mp3(data)
+
+
+class CommandBackend(TTSBackend):
+    """离线引擎：在进程池中调用本地命令行合成器，每个CPU核心一个合成进程
+
+    command是参数列表，可使用占位符：
+      {text} {text_file} 要合成的文本 / 保存文本的文件
+      {output}           合成器写入的音频文件（扩展名为output_suffix，不是MP3时用ffmpeg转换）
+      {voice} {speed} {amplitude} {rate_percent} {volume_percent} {pitch_percent}
+    speed为speed_base按语速百分比换算后的值（如espeak的每分钟词数），amplitude为音量（正常为100）
+    """
+
+    adaptive = False
+    max_payload_bytes = 2000  # 本地引擎单段越短，越能均匀分配到各个核心
+
+    def __init__(self, command, name=None, output_suffix=".wav", default_voice="", voices=None,
+                 speed_base=175, max_workers=None, timeout=300.0):
+        self.command = list(command)
+        self.name = name or os.path.basename(self.command[0])
+        self.output_format = f"{self.name}/mp3-{MP3_SAMPLE_RATE // 1000}khz-{MP3_BITRATE}bitrate-mono"
+        self.output_suffix = output_suffix
+        self.default_voice = default_voice
+        self._voices = voices or []
+        self.speed_base = speed_base
+        self.recommended_concurrency = max_workers or os.cpu_count() or 2
+        self.max_concurrency = self.recommended_concurrency
+        self.timeout = timeout
+        self.executor = None
+
+    async def synthesize(self, text, voice, rate="+0%", volume="+0%", pitch="+0Hz"):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.recommended_concurrency)
+        fields = {
+            "voice": voice or self.default_voice,
+            "speed": round(self.speed_base * (100 + percent(rate)) / 100),
+            "amplitude": max(0, 100 + percent(volume)),
+            "rate_percent": percent(rate),
+            "volume_percent": percent(volume),
+            "pitch_percent": percent(pitch),
+        }
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, run_command, self.command, self.output_suffix,
+                                          text, fields, self.timeout)
+
+    async def voices(self):
+        return list(self._voices)
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+def espeak_voices(program):
+    """解析espeak-ng --voices的输出"""
+    try:
+        output = subprocess.run([program, "--voices"], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return []
+    voices = []
+    for line in output.splitlines()[1:]:
+        parts = line.split()
+        if len(parts) >= 4:
+            gender = {"M": "Male", "F": "Female"}.get(parts[2].split('/')[-1], "")
+            voices.append({"name": parts[1], "locale": parts[1], "gender": gender})
+    return voices
+
+
+def espeak_backend(program=None, max_workers=None):
+    """基于espeak-ng的离线引擎，默认普通话"""
+    program = program or shutil.which("espeak-ng") or shutil.which("espeak")
+    if not program:
+        raise RuntimeError("没有找到espeak-ng，请先安装")
+    command = [program, "-v", "{voice}", "-s", "{speed}", "-a", "{amplitude}", "-w", "{output}", "-f", "{text_file}"]
+    return CommandBackend(command, name="espeak-ng", default_voice="cmn", voices=espeak_voices(program),
+                          max_workers=max_workers)
+
+
+BACKENDS = {
+    "edge": EdgeBackend,
+    "espeak": espeak_backend,
+}
+
+
+def create_backend(name, command=None, **kwargs):
+    """按名称创建后端；name为"command"时使用自定义命令（字符串按shell规则分隔）"""
+    if name == "command":
+        if not command:
+            raise ValueError("command后端需要指定合成命令")
+        return CommandBackend(shlex.split(command) if isinstance(command, str) else command, **kwargs)
+    if name not in BACKENDS:
+        raise ValueError(f"未知的TTS后端: {name}")
+    return BACKENDS[name](**kwargs)
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text):
+    """规范化文本（合并空白），用于生成缓存键"""
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def synthesis_key(text, voice, rate, volume, pitch, output_format):
+    """根据文本和合成参数生成内容寻址的缓存键"""
+    digest = hashlib.sha256()
+    for part in (normalize_text(text), voice, rate, volume, pitch, output_format):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class TTSCache:
+    """TTS音频段的磁盘缓存，超出容量上限时按LRU淘汰
+
+    后端返回词边界时保存在音频旁边的.json文件中，与音频一起淘汰
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> 文件大小，按最近使用排序
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        """扫描缓存目录，按修改时间恢复LRU顺序"""
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        found = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for name in filenames:
+                if not name.endswith('.mp3'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, name[:-4], stat.st_size))
+
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self.total_bytes += size
+        logger.info("TTS缓存: %d 段, %d 字节", len(self._entries), self.total_bytes)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.mp3")
+
+    def boundaries_path_for(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get_boundaries(self, key):
+        """缓存段的词边界[(开始秒数, 时长秒数, 文本)]，没有保存时返回None"""
+        try:
+            with open(self.boundaries_path_for(key), encoding='utf-8') as f:
+                return [tuple(item) for item in json.load(f)]
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key):
+        """查找缓存，命中时返回文件路径并刷新使用时间，否则返回None"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+
+            path = self.path_for(key)
+            if not os.path.exists(path):
+                self.total_bytes -= self._entries.pop(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def put_bytes(self, key, data, boundaries=None):
+        """将内存中的音频数据（以及词边界）写入缓存；词边界先写入，有音频时边界一定完整"""
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.part"
+        if boundaries is not None:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump([list(boundary) for boundary in boundaries], f, ensure_ascii=False)
+            os.replace(temp_path, self.boundaries_path_for(key))
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self._add(key, len(data))
+
+    def _add(self, key, size):
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)
+            self._entries[key] = size
+            self.total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        """淘汰最久未使用的条目直到总大小不超过上限"""
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path_for(key))
+            except OSError as e:
+                logger.warning("清理缓存文件失败: %s, %s", key, e)
+            try:
+                os.remove(self.boundaries_path_for(key))
+            except OSError:
+                pass
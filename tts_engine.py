@@ -0,0 +1,150 @@
+"""常驻的转换引擎：一个后台线程运行事件循环和任务队列，GUI通过线程安全的方法提交和控制转换
+
+事件循环、TTS后端、限速器和调度器在多次转换之间保留，不再每次转换都新建线程和事件循环。
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+
+from chunk_scheduler import call_in_loop
+
+logger = logging.getLogger(__name__)
+
+
+class TTSEngine:
+    """转换引擎：submit/pause/resume/cancel可从任意线程调用
+
+    状态变化通过subscribe注册的回调发布，回调在引擎线程中调用，参数为事件字典：
+      {"event": "progress", "job", "completed", "total", "title", "status", "chapter_id", "stats"}
+                                    stats为引擎线程中取得的(并发数, 字/秒, 实时倍率)，尚未开始合成时为None
+      {"event": "state", "job"}     任务开始、暂停、继续、取消，当前状态为job.state
+      {"event": "finished", "job"}  任务结束（完成、失败或取消）
+    """
+
+    def __init__(self, backend=None, max_active_books=1):
+        self.backend = backend
+        self.max_active_books = max_active_books
+        self.loop = None
+        self.queue = None
+        self.thread = None
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """启动引擎线程，事件循环和任务队列就绪后返回"""
+        if self.thread is not None:
+            return
+        ready = threading.Event()
+        self.thread = threading.Thread(target=asyncio.run, args=(self._main(ready),), name="tts-engine", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    async def _main(self, ready):
+        # 转换相关的模块在引擎线程中导入，不推迟窗口显示
+        from job_queue import JobQueue
+        self.loop = asyncio.get_running_loop()
+        self.queue = JobQueue(max_active_books=self.max_active_books, on_job_finished=self._on_job_finished,
+                              backend=self.backend, keep_alive=True, shared_metrics=False)
+        self.backend = self.queue.backend
+        ready.set()
+        try:
+            await self.queue.run()
+        finally:
+            self.backend.close()
+
+    def _call(self, func, *args):
+        """在引擎线程中执行并等待返回值"""
+        if threading.current_thread() is self.thread:
+            return func(*args)
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(run)
+        return future.result()
+
+    def subscribe(self, listener):
+        """注册事件回调，返回取消注册的函数"""
+        with self._lock:
+            self._listeners.append(listener)
+
+        def unsubscribe():
+            with self._lock:
+                if listener in self._listeners:
+                    self._listeners.remove(listener)
+        return unsubscribe
+
+    def _publish(self, event, job, **data):
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(dict(data, event=event, job=job))
+            except Exception as e:
+                logger.error("事件回调失败: %s", e)
+
+    def _on_progress(self, job, completed, total, title, status, chapter_id):
+        # 限速器和统计只在引擎线程中修改，这里取快照随事件发出，界面线程不直接读取
+        converter = job.converter
+        stats = None
+        if converter and converter.limiter:
+            _, chars_per_second = converter.limiter.throughput()
+            stats = (converter.limiter.limit, chars_per_second, converter.metrics.rate('audio_seconds'))
+        self._publish("progress", job, completed=completed, total=total, title=title, status=status,
+                      chapter_id=chapter_id, stats=stats)
+
+    def _on_job_finished(self, job):
+        self._publish("finished", job)
+
+    def submit(self, epub_path, output_dir, select=None, max_concurrent=None, **settings):
+        """加入一本书，返回BookJob
+
+        max_concurrent为None时自动调整并发；settings同JobQueue.submit（voice/rate/volume/pitch/chapter_order/book等）
+        """
+        def submit():
+            self.queue.set_concurrency(max_concurrent)
+            job = self.queue.submit(epub_path, output_dir, select=select, progress_callback=self._on_progress,
+                                    **settings)
+            self._publish("state", job)
+            return job
+        return self._call(submit)
+
+    def _control(self, action, job):
+        def run():
+            action(job)
+            self._publish("state", job)
+        call_in_loop(self.loop, run)
+
+    def pause(self, job):
+        self._control(self.queue.pause, job)
+
+    def resume(self, job):
+        self._control(self.queue.resume, job)
+
+    def cancel(self, job):
+        self._control(self.queue.cancel, job)
+
+    def run_in_background(self, func, *args):
+        """在引擎的线程池中执行阻塞的操作（如保存文本），返回concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(self._in_executor(func, *args), self.loop)
+
+    async def _in_executor(self, func, *args):
+        return await self.loop.run_in_executor(None, func, *args)
+
+    def close(self, timeout=5.0):
+        """取消所有任务并停止引擎线程，最多等待timeout秒"""
+        if self.thread is None:
+            return
+
+        def close():
+            for job in list(self.queue.jobs):
+                self.queue.cancel(job)
+            self.queue.close()
+        call_in_loop(self.loop, close)
+        self.thread.join(timeout)
+        self.thread = None